@@ -0,0 +1,154 @@
+"""
+One book collecting the posts of several blogs.
+
+Every feed is parsed as a stream and the entries are merged newest first by
+their publishing date, holding one entry per blog, the way a single feed is
+read. Sections then go through the same spool as a single book and come out
+oldest first. Every section names the author of its blog under the title.
+"""
+import calendar
+from hashlib import sha1
+import heapq
+from blogspot2fb2 import BloggerToBook, TreeWrapper, ENTRY_PUBLISHED, FEED_AUTHOR_EMAIL, FEED_AUTHOR_NAME, \
+    FEED_AUTHOR_URI, FEED_ID, FEED_LINK, FEED_TITLE, FEED_UPDATED, parse_date
+import logging
+
+_logger = logging.getLogger('feed-fb2.anthology')
+_logger.addHandler(logging.NullHandler())
+
+# index of the blog an entry comes from, set on the entry while it is merged
+SOURCE_ATTR = 'feed-fb2-source'
+
+class Anthology(BloggerToBook):
+    """
+    Merges several feeds into one book. Feeds are expected newest first,
+    as Blogger returns them.
+    """
+    def __init__(self, sources, genre, lang, title=None, **options):
+        """
+        @param sources: a feed file or an iterable of feed page files per blog
+        @type genre: list
+        @type lang: str
+        @param title: book title, the blog titles joined by default
+        @param options: as for BloggerToBook
+        """
+        self.book_title = title
+        BloggerToBook.__init__(self, list(sources), genre, lang, **options)
+        # feed update time of the blog updated last
+        self.updated = max(self.roots, key=lambda root: root.xpath_date(FEED_UPDATED)).xpath_value(FEED_UPDATED)
+
+    def _parse(self, sources):
+        """
+        Yields the header of the first feed and then the entries of all feeds
+        """
+        feeds = [BloggerToBook._parse(self, [source] if hasattr(source, 'read') else source) for source in sources]
+        self.roots = [TreeWrapper(next(feed)) for feed in feeds]
+        self.authors = [root.xpath_value(FEED_AUTHOR_NAME) for root in self.roots]
+        yield self.roots[0].tree
+
+        for entry in self._merge(feeds):
+            yield entry
+
+    @staticmethod
+    def _order(entry):
+        # newest first
+        published = parse_date(ENTRY_PUBLISHED(entry)[0])
+        return -(calendar.timegm(published.utctimetuple()) + published.microsecond / 1e6)
+
+    def _merge(self, feeds):
+        """
+        k-way merge of the feeds, every feed is read as far as its newest
+        entry not yielded yet
+        """
+        heap = []
+        for i, feed in enumerate(feeds):
+            entry = next(feed, None)
+            if entry is not None:
+                heap.append((self._order(entry), i, entry))
+        heapq.heapify(heap)
+
+        while heap:
+            _order, i, entry = heap[0]
+            entry.set(SOURCE_ATTR, str(i))
+            # the feed drops the entry once it is asked for the next one
+            yield entry
+
+            entry = next(feeds[i], None)
+            if entry is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (self._order(entry), i, entry))
+
+    def entry_fields(self, entry):
+        """
+        @type entry: TreeWrapper
+        @return: cache key of the entry, its title, publishing date, html content and author
+        """
+        key, fields = BloggerToBook.entry_fields(entry)
+        return key, fields + (self.authors[int(entry.tree.get(SOURCE_ATTR))],)
+
+    def _header(self, tree, volume=None, label=None):
+        authors = [
+            (root.xpath_value(FEED_AUTHOR_NAME), root.xpath_value(FEED_AUTHOR_EMAIL), root.xpath_value(FEED_AUTHOR_URI))
+            for root in self.roots
+        ]
+        titles = [root.xpath_value(FEED_TITLE) for root in self.roots]
+        # the same blogs make the same book
+        bookId = sha1('\n'.join(root.xpath_value(FEED_ID) for root in self.roots).encode('utf-8')).hexdigest()
+        date = max(root.xpath_date(FEED_UPDATED) for root in self.roots)
+        return self._describe(authors, self.book_title or ', '.join(titles), titles, bookId,
+                              [root.xpath_value(FEED_LINK) for root in self.roots], date, volume, label)
+
+if __name__ == '__main__':
+    import multiprocessing
+    import optparse
+    from blogspot2fb2 import add_book_options, add_conversion_options, add_worker_options
+    from blogspot2fb2 import converter_version, open_source, parse_prune, setup_logging
+    from compress import compressed, compression_for, entry_name
+    from httpcache import HttpCache
+    from sectioncache import SectionCache
+
+    parser = optparse.OptionParser(usage='%prog [options] SOURCE... OUTPUT')
+    add_book_options(parser)
+    parser.add_option("-t", "--title", action="store", dest='title', default=None,
+                      help='book title, the blog titles joined by default')
+    add_worker_options(parser, per='blog')
+    add_conversion_options(parser)
+
+    log = setup_logging()
+
+    options, args = parser.parse_args()
+    if len(args) < 3:
+        parser.error('at least two sources and an output expected')
+    if not options.genre:
+        options.genre = ['ref_ref']
+
+    prune = parse_prune(parser, options)
+
+    cache = HttpCache(options.cache_dir, options.cache_size << 20) if options.cache_dir else None
+    section_cache = None
+    if options.section_cache_path:
+        # sections of an anthology name their author
+        version = converter_version(False, options.engine, prune) + '+anthology'
+        section_cache = SectionCache(options.section_cache_path, version)
+
+    # the process pool is forked before the fetcher threads start
+    pool = multiprocessing.Pool(options.jobs) if options.jobs > 1 else None
+    sources = [open_source(spec, options.fetch_workers, cache) for spec in args[:-1]]
+    book = Anthology(sources, options.genre, options.lang, options.title, engine=options.engine, prune=prune,
+                     jobs=options.jobs, pool=pool, section_cache=section_cache)
+
+    path = args[-1]
+    with open(path, 'wb') as o:
+        out = compressed(o, options.compress or compression_for(path), entry_name(path))
+        book.write(out)
+        if out is not o:
+            out.close()
+    log.info('Anthology of %d blogs saved into %s' % (len(sources), path))
+
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+
+    if section_cache is not None:
+        section_cache.close()
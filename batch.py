@@ -0,0 +1,211 @@
+"""
+Converts many feeds in one process.
+
+The job list has one job per line: source spec (blogspot:<name> or a local
+path), output path, comma separated genres and language. Genres and
+language may be omitted, empty lines and lines starting with # are skipped.
+Outputs ending with .zip or .gz are compressed.
+
+    blogspot:someblog   books/someblog.fb2   sf_fantasy,ref_ref   ru
+    dumps/other.xml     books/other.fb2
+"""
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import shlex
+import time
+import traceback
+from blogspot2fb2 import BloggerToBook, add_conversion_options, add_image_options, add_worker_options, \
+    converter_version, open_source, parse_prune, setup_logging
+from compress import compressed, compression_for, entry_name
+from fetcher import BlogspotFetcher
+from httpcache import HttpCache
+from images import ImageStore
+from sectioncache import SectionCache
+import logging
+
+_logger = logging.getLogger('feed-fb2.batch')
+_logger.addHandler(logging.NullHandler())
+
+DEFAULT_GENRE = 'ref_ref'
+DEFAULT_LANG = 'en'
+
+class Job(object):
+    def __init__(self, source, output, genre=None, lang=None):
+        """
+        @type source: str
+        @type output: str
+        @type genre: list
+        @type lang: str
+        """
+        self.source = source
+        self.output = output
+        self.genre = genre or [DEFAULT_GENRE]
+        self.lang = lang or DEFAULT_LANG
+
+        self.ok = None
+        self.error = None
+        self.seconds = None
+
+    @classmethod
+    def parse(cls, line):
+        """
+        @rtype: Job
+        """
+        fields = shlex.split(line)
+        if len(fields) < 2 or len(fields) > 4:
+            raise ValueError('Invalid job: %r' % line)
+
+        source, output = fields[:2]
+        genre = [g for g in fields[2].split(',') if g] if len(fields) > 2 else None
+        lang = fields[3] if len(fields) > 3 else None
+        return cls(source, output, genre, lang)
+
+def read_jobs(stream):
+    """
+    @type stream: file
+    @rtype: list
+    """
+    jobs = []
+    for line in stream:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            jobs.append(Job.parse(line))
+
+    return jobs
+
+class Batch(object):
+    """
+    Runs jobs on a thread pool. Threads share the http cache, the section
+    cache, the image store and one process pool converting entries.
+    """
+    WORKERS = 4
+
+    def __init__(self, workers=WORKERS, jobs=1, fetch_workers=BlogspotFetcher.WORKERS,
+                 http_cache=None, section_cache=None, image_store=None, pool=None, **options):
+        """
+        @param workers: books converted at once
+        @param jobs: processes converting entries, shared by all books
+        @param pool: process pool of that size, forked before the threads of
+            the image store; created by run if not given
+        @type http_cache: HttpCache
+        @type section_cache: SectionCache
+        @type image_store: ImageStore
+        @param options: passed on to BloggerToBook
+        """
+        self.workers = workers
+        self.jobs = jobs
+        self.fetch_workers = fetch_workers
+        self.http_cache = http_cache
+        self.pool = pool
+        self.options = dict(options, section_cache=section_cache, image_store=image_store, jobs=jobs)
+
+    def run(self, jobs):
+        """
+        @type jobs: list
+        """
+        # the process pool is forked before the threads of the batch start
+        own = multiprocessing.Pool(self.jobs) if self.pool is None and self.jobs > 1 else None
+        pool = self.pool or own
+        threads = ThreadPool(self.workers)
+        try:
+            threads.map(lambda job: self.run_job(job, pool), jobs, chunksize=1)
+        finally:
+            threads.close()
+            threads.join()
+            if own is not None:
+                own.terminate()
+                own.join()
+
+    def run_job(self, job, pool):
+        """
+        @type job: Job
+        """
+        _logger.info('Starting %s' % job.source)
+        started = time.time()
+        # the book of the previous run stays in place unless this one is complete
+        tmp = job.output + '.tmp'
+        try:
+            stream = open_source(job.source, self.fetch_workers, self.http_cache)
+            book = BloggerToBook(stream, job.genre, job.lang, pool=pool, **self.options)
+            with open(tmp, 'wb') as o:
+                out = compressed(o, compression_for(job.output), entry_name(job.output))
+                book.write(out)
+                if out is not o:
+                    out.close()
+            os.rename(tmp, job.output)
+        except Exception, e:
+            _logger.error('%s failed: %s' % (job.source, traceback.format_exc()))
+            job.ok = False
+            job.error = '%s: %s' % (e.__class__.__name__, e)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        else:
+            job.ok = True
+        job.seconds = time.time() - started
+        _logger.info('Finished %s in %.1fs' % (job.source, job.seconds))
+
+def report(jobs, stream):
+    """
+    Per-job status and timing table
+
+    @type jobs: list
+    @type stream: file
+    """
+    for job in jobs:
+        status = 'OK' if job.ok else 'FAILED'
+        stream.write('%-6s %8.1fs  %s -> %s' % (status, job.seconds or 0, job.source, job.output))
+        if job.error:
+            stream.write('  (%s)' % job.error)
+        stream.write('\n')
+
+    failed = sum(1 for job in jobs if not job.ok)
+    stream.write('%d jobs, %d failed, %.1fs total\n' % (len(jobs), failed, sum(job.seconds or 0 for job in jobs)))
+
+if __name__ == '__main__':
+    import sys
+    import optparse
+
+    parser = optparse.OptionParser(usage='%prog [options] JOBLIST')
+    parser.add_option("-b", "--books", action="store", type="int", dest='workers', default=Batch.WORKERS,
+                      help='number of books converted at once')
+    add_worker_options(parser, per='book', shared_by='books')
+    add_conversion_options(parser)
+    add_image_options(parser)
+
+    log = setup_logging()
+
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('job list expected')
+
+    prune = parse_prune(parser, options)
+
+    with open(args[0]) as f:
+        jobs = read_jobs(f)
+
+    # the process pool is forked before the image store starts its threads
+    pool = multiprocessing.Pool(options.jobs) if options.jobs > 1 else None
+    http_cache = HttpCache(options.cache_dir, options.cache_size << 20) if options.cache_dir else None
+    image_store = ImageStore(options.image_dir, options.image_workers) if options.image_dir else None
+    section_cache = None
+    if options.section_cache_path:
+        version = converter_version(bool(options.image_dir), options.engine, prune)
+        section_cache = SectionCache(options.section_cache_path, version)
+
+    batch = Batch(options.workers, options.jobs, options.fetch_workers,
+                  http_cache=http_cache, section_cache=section_cache, image_store=image_store,
+                  pool=pool, engine=options.engine, prune=prune)
+    try:
+        batch.run(jobs)
+    finally:
+        if section_cache is not None:
+            section_cache.close()
+        if image_store is not None:
+            image_store.close()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    report(jobs, sys.stdout)
+    sys.exit(0 if all(job.ok for job in jobs) else 1)
@@ -0,0 +1,327 @@
+"""
+Benchmarks for BloggerToBook and HtmlToFb on synthetic Blogger feeds.
+
+Every stage runs in a child process of its own, so that the peak resident
+size reported for it is not inflated by the other stages:
+
+    parse      feed iterparse, entry fields and etree.HTML of every post
+    convert    HtmlToFb over already parsed posts
+    serialize  writing already converted sections with etree.xmlfile
+    book       the whole BloggerToBook pipeline
+
+Results are saved as json, a previous result file may be given to compare
+throughput against.
+"""
+from cgi import escape
+import json
+import multiprocessing
+import os
+import random
+import resource
+import tempfile
+import time
+import traceback
+from lxml import etree
+from blogspot2fb2 import BloggerToBook, ENTRY_TAG, TreeWrapper
+from html2fb2 import HtmlToFb
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+         'incididunt ut labore et dolore magna aliqua').split()
+
+STYLES = [
+    'font-weight: bold', 'font-style: italics', 'font-weight: normal', 'color: red',
+    'font-family: Georgia, serif; font-size: 12px', 'text-align: justify;',
+]
+
+INLINE = ['b', 'i', 'em', 'strong', 'span', 's', 'sup', 'code', 'a']
+# Blogger puts inline styles on these only
+STYLED = ['span', 'p', 'div']
+
+class FeedGenerator(object):
+    """
+    Synthetic Blogger Atom feed
+    """
+    def __init__(self, entries=200, post_size=4000, depth=3, style_density=0.3,
+                 table_frequency=0.05, br_frequency=0.1, seed=0):
+        """
+        @param entries: number of posts
+        @param post_size: approximate post text length, in characters
+        @param depth: maximal nesting of inline elements
+        @param style_density: share of span, p and div elements with a style attribute
+        @param table_frequency: chance of a table in place of a paragraph
+        @param br_frequency: chance of a line break after a word run
+        """
+        self.entries = entries
+        self.post_size = post_size
+        self.depth = depth
+        self.style_density = style_density
+        self.table_frequency = table_frequency
+        self.br_frequency = br_frequency
+        self.seed = seed
+
+    def params(self):
+        return dict(self.__dict__)
+
+    def _words(self, rnd, count):
+        return ' '.join(rnd.choice(WORDS) for _i in range(count))
+
+    def _open(self, rnd, tag):
+        if tag in STYLED and rnd.random() < self.style_density:
+            return '<%s style="%s">' % (tag, rnd.choice(STYLES))
+        return '<%s>' % tag
+
+    def _inline(self, rnd, depth):
+        out = [self._words(rnd, rnd.randint(3, 12))]
+        if depth < self.depth and rnd.random() < 0.5:
+            tag = rnd.choice(INLINE)
+            out.append(' ' + self._open(rnd, tag) + self._inline(rnd, depth + 1) + '</%s> ' % tag)
+            out.append(self._words(rnd, rnd.randint(1, 6)))
+        if rnd.random() < self.br_frequency:
+            out.append('<br />' * rnd.randint(1, 3))
+        return ''.join(out)
+
+    def _table(self, rnd):
+        rows = []
+        for _r in range(rnd.randint(1, 4)):
+            cells = ''.join('<td>%s</td>' % self._inline(rnd, self.depth - 1) for _c in range(rnd.randint(1, 4)))
+            rows.append('<tr>%s</tr>' % cells)
+        return '<table>%s</table>' % ''.join(rows)
+
+    def post(self, rnd):
+        out = []
+        size = 0
+        while size < self.post_size:
+            if rnd.random() < self.table_frequency:
+                block = self._table(rnd)
+            else:
+                tag = rnd.choice(['p', 'div'])
+                block = self._open(rnd, tag) + self._inline(rnd, 0) + '</%s>' % tag
+            out.append(block)
+            size += len(block)
+        return ''.join(out)
+
+    def write(self, stream):
+        """
+        @type stream: file
+        """
+        rnd = random.Random(self.seed)
+        stream.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                     '<feed xmlns="http://www.w3.org/2005/Atom" '
+                     'xmlns:openSearch="http://a9.com/-/spec/opensearchrss/1.0/">'
+                     '<id>tag:blogger.com,1999:blog-1</id>'
+                     '<updated>2012-01-01T00:00:00.000+00:00</updated>'
+                     '<title type="text">Benchmark</title>'
+                     '<subtitle type="html">Synthetic feed</subtitle>'
+                     '<link rel="alternate" type="text/html" href="http://benchmark.blogspot.com/"/>'
+                     '<author><name>Bench Mark</name><uri>http://benchmark.blogspot.com/</uri>'
+                     '<email>noreply@blogger.com</email></author>'
+                     '<openSearch:totalResults>%d</openSearch:totalResults>\n' % self.entries)
+
+        for i in range(self.entries, 0, -1):
+            date = '20%02d-%02d-%02dT12:00:00.000+00:00' % (i // 336 % 100, i // 28 % 12 + 1, i % 28 + 1)
+            stream.write('<entry><id>tag:blogger.com,1999:blog-1.post-%d</id>'
+                         '<published>%s</published><updated>%s</updated>'
+                         '<title type="text">Post %d</title>'
+                         '<content type="html">%s</content></entry>\n' % (i, date, date, i, escape(self.post(rnd))))
+
+        stream.write('</feed>\n')
+
+class CountingSink(object):
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+def _read_entries(path):
+    fields = []
+    for _event, entry in etree.iterparse(path, events=('end',), tag=ENTRY_TAG):
+        fields.append(BloggerToBook.entry_fields(TreeWrapper(entry))[1])
+        entry.clear()
+    return fields
+
+def stage_parse(path, engine):
+    fields = _read_entries(path)
+    trees = [etree.HTML(content) for _title, _published, content in fields]
+    return len(trees), os.path.getsize(path)
+
+def stage_convert(path, engine):
+    trees = [etree.HTML(content) for _title, _published, content in _read_entries(path)]
+    size = sum(len(etree.tostring(t)) for t in trees)
+
+    started = time.time()
+    for tree in trees:
+        HtmlToFb(tree, engine).get_tree()
+    return len(trees), size, time.time() - started
+
+def stage_serialize(path, engine):
+    sections = [BloggerToBook.convert(*fields, engine=engine) for fields in _read_entries(path)]
+
+    sink = CountingSink()
+    started = time.time()
+    with etree.xmlfile(sink, encoding='utf-8') as xf:
+        with xf.element('body'):
+            for section in sections:
+                xf.write('\n    ', section)
+    return len(sections), sink.size, time.time() - started
+
+def stage_book(path, engine):
+    sink = CountingSink()
+    with open(path) as f:
+        BloggerToBook(f, ['ref_ref'], 'en', engine=engine).write(sink)
+    return None, os.path.getsize(path)
+
+STAGES = [
+    ('parse', stage_parse),
+    ('convert', stage_convert),
+    ('serialize', stage_serialize),
+    ('book', stage_book),
+]
+
+class StageError(Exception):
+    pass
+
+def _child(stage, path, engine, conn):
+    try:
+        started = time.time()
+        result = stage(path, engine)
+        seconds = time.time() - started
+        if len(result) == 3:
+            # the stage timed its own loop, setup excluded
+            items, size, seconds = result
+        else:
+            items, size = result
+        conn.send((items, size, seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    except Exception:
+        conn.send(traceback.format_exc())
+    conn.close()
+
+def run_stage(stage, path, engine):
+    """
+    @return: entries, processed bytes, seconds and peak rss in KiB
+    """
+    parent, child = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=_child, args=(stage, path, engine, child))
+    process.start()
+    # otherwise recv would never see the end of a crashed child
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        raise StageError('%s died with exit code %s' % (stage.__name__, process.exitcode))
+    finally:
+        process.join()
+
+    if isinstance(result, basestring):
+        raise StageError('%s failed:\n%s' % (stage.__name__, result))
+    return result
+
+def run(generator, engine=HtmlToFb.SAX, repeat=3):
+    """
+    @type generator: FeedGenerator
+    @return: json-serializable results
+    """
+    fd, path = tempfile.mkstemp(suffix='.xml')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            generator.write(f)
+
+        results = {}
+        for name, stage in STAGES:
+            # the best of several runs, peak rss is the largest one seen
+            runs = [run_stage(stage, path, engine) for _i in range(repeat)]
+            items, size, seconds, _rss = min(runs, key=lambda r: r[2])
+            results[name] = {
+                'seconds': seconds,
+                'entries_per_s': generator.entries / seconds if seconds else None,
+                'mb_per_s': size / seconds / (1 << 20) if seconds else None,
+                'peak_rss_kb': max(r[3] for r in runs),
+            }
+
+        return {
+            'params': generator.params(),
+            'engine': engine,
+            'feed_bytes': os.path.getsize(path),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results,
+        }
+    finally:
+        os.remove(path)
+
+def compare(current, previous, tolerance=0.1):
+    """
+    @return: report lines and whether any stage regressed by more than tolerance
+    """
+    lines = []
+    regressed = False
+    if current['params'] != previous['params'] or current['engine'] != previous['engine']:
+        lines.append('warning: benchmark parameters differ')
+
+    for name, _stage in STAGES:
+        now = current['results'].get(name)
+        before = previous['results'].get(name)
+        if not now or not before or not before['seconds']:
+            continue
+
+        speed = before['seconds'] / now['seconds']
+        rss = float(now['peak_rss_kb']) / before['peak_rss_kb']
+        bad = speed < 1 - tolerance or rss > 1 + tolerance
+        regressed = regressed or bad
+        lines.append('%-10s speed x%.2f  rss x%.2f%s' % (name, speed, rss, '  REGRESSION' if bad else ''))
+
+    return lines, regressed
+
+def format_results(data):
+    lines = []
+    for name, _stage in STAGES:
+        r = data['results'][name]
+        lines.append('%-10s %8.3fs %9.1f entries/s %7.2f MB/s %8d KiB peak rss' % (
+            name, r['seconds'], r['entries_per_s'] or 0, r['mb_per_s'] or 0, r['peak_rss_kb']))
+    return lines
+
+if __name__ == '__main__':
+    import sys
+    import optparse
+
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--entries", action="store", type="int", dest='entries', default=200)
+    parser.add_option("-s", "--post-size", action="store", type="int", dest='post_size', default=4000,
+                      help='approximate post length, characters')
+    parser.add_option("-d", "--depth", action="store", type="int", dest='depth', default=3,
+                      help='inline element nesting depth')
+    parser.add_option("--style-density", action="store", type="float", dest='style_density', default=0.3)
+    parser.add_option("--table-frequency", action="store", type="float", dest='table_frequency', default=0.05)
+    parser.add_option("--br-frequency", action="store", type="float", dest='br_frequency', default=0.1)
+    parser.add_option("--seed", action="store", type="int", dest='seed', default=0)
+    parser.add_option("-e", "--engine", action="store", dest='engine', default=HtmlToFb.SAX,
+                      choices=HtmlToFb.ENGINES)
+    parser.add_option("-r", "--repeat", action="store", type="int", dest='repeat', default=3)
+    parser.add_option("-o", "--output", action="store", dest='output', default=None,
+                      help='save results as json')
+    parser.add_option("-c", "--compare", action="store", dest='compare', default=None,
+                      help='previous results to compare with')
+    parser.add_option("--tolerance", action="store", type="float", dest='tolerance', default=0.1)
+    parser.add_option("--feed", action="store", dest='feed', default=None,
+                      help='only write the synthetic feed to this file')
+
+    options, args = parser.parse_args()
+    generator = FeedGenerator(options.entries, options.post_size, options.depth, options.style_density,
+                              options.table_frequency, options.br_frequency, options.seed)
+
+    if options.feed:
+        with open(options.feed, 'w') as f:
+            generator.write(f)
+        sys.exit(0)
+
+    data = run(generator, options.engine, options.repeat)
+    print '\n'.join(format_results(data))
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            lines, regressed = compare(data, json.load(f), options.tolerance)
+        print '\n'.join(lines)
+        sys.exit(1 if regressed else 0)
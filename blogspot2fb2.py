@@ -1,12 +1,24 @@
+from collections import deque
 from datetime import datetime
 import getpass
 from lxml import etree
+import multiprocessing
 import os
 from dateutil.parser import parse
+from dateutil.tz import tzoffset, tzutc
 import re
+import sys
+import tempfile
 import time
-from urllib2 import urlopen
+from compress import COMPRESSIONS, compressed, compression_for, entry_name
+from fetcher import BlogspotFetcher, NSFEED
+import html2fb2
 from html2fb2 import HtmlToFb
+from httpcache import HttpCache
+from images import ImageStore, XLINK
+from prune import DEFAULT_RULES, RULES as PRUNE_RULES, pruner
+from sectioncache import SectionCache
+from stats import NULL_STATS, Stats, TimedStream
 import logging
 
 _logger = logging.getLogger('feed-fb2.writer')
@@ -14,13 +26,72 @@ _logger.addHandler(logging.NullHandler())
 
 VERSION = '0.1'
 PROGRAM_NAME = 'blogspot2fb v%s' % VERSION
+# cached sections are only valid for the converter that produced them
+CONVERTER_VERSION = '%s/%s' % (VERSION, html2fb2.VERSION)
+
+ENTRY_TAG = '{%s}entry' % NSFEED['a']
+
+def converter_version(images=False, engine=None, prune=()):
+    """
+    Version cached sections are stored under, for the given conversion options
+    """
+    version = CONVERTER_VERSION
+    # sections with image placeholders differ from the plain ones
+    if images:
+        version += '+images'
+    # the xslt engine does not match the others on every post
+    if engine == HtmlToFb.XSLT:
+        version += '+xslt'
+    if prune:
+        version += '+prune:' + ','.join(prune)
+    return version
+
+def _xpath(path):
+    return etree.XPath(path, namespaces=NSFEED)
+
+# compiled once, feed paths are evaluated against the feed root
+FEED_AUTHOR_NAME = _xpath('/a:feed/a:author/a:name/text()')
+FEED_AUTHOR_EMAIL = _xpath('/a:feed/a:author/a:email/text()')
+FEED_AUTHOR_URI = _xpath('/a:feed/a:author/a:uri/text()')
+FEED_TITLE = _xpath('/a:feed/a:title/text()')
+FEED_SUBTITLE = _xpath('/a:feed/a:subtitle/text()')
+FEED_ID = _xpath('/a:feed/a:id/text()')
+FEED_LINK = _xpath('/a:feed/a:link[@rel="alternate" and @type="text/html" and @href]/@href')
+FEED_UPDATED = _xpath('/a:feed/a:updated/text()')
+
+ENTRY_ID = _xpath('./a:id/text()')
+ENTRY_UPDATED = _xpath('./a:updated/text()')
+ENTRY_TITLE = _xpath('./a:title/text()')
+ENTRY_PUBLISHED = _xpath('./a:published/text()')
+ENTRY_CONTENT = _xpath('./a:content/text()')
+
+# Blogger writes every timestamp as 2011-10-22T11:00:00.000+02:00
+RFC3339 = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d+))?(?:(Z)|([+-])(\d\d):(\d\d))$')
+UTC = tzutc()
+
+def parse_date(text):
+    """
+    RFC 3339 timestamps are parsed directly, anything else by dateutil
+
+    @rtype: datetime
+    """
+    m = RFC3339.match(text)
+    if m is None:
+        return parse(text)
+
+    year, month, day, hour, minute, second, fraction, utc, sign, tz_hour, tz_minute = m.groups()
+    if utc or tz_hour == tz_minute == '00':
+        tz = UTC
+    else:
+        offset = int(tz_hour) * 3600 + int(tz_minute) * 60
+        tz = tzoffset(None, -offset if sign == '-' else offset)
 
-NSFEED = {
-    'a': 'http://www.w3.org/2005/Atom',
-    's': 'http://a9.com/-/spec/opensearchrss/1.0/',
-}
+    microsecond = int(fraction[:6].ljust(6, '0')) if fraction else 0
+    return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), microsecond, tz)
 
 class TreeWrapper(object):
+    # paths given as strings, compiled on first use
+    XPATHS = {}
 
     def __init__(self, tree):
         """
@@ -29,16 +100,24 @@ class TreeWrapper(object):
         self.tree = tree
 
     def xpath(self, path):
-        return self.tree.xpath(path, namespaces=NSFEED)
+        """
+        @param path: compiled etree.XPath or an expression
+        """
+        if isinstance(path, basestring):
+            compiled = self.XPATHS.get(path)
+            if compiled is None:
+                compiled = self.XPATHS[path] = _xpath(path)
+            path = compiled
+        return path(self.tree)
 
     def xpath_value(self, path):
-        return self.tree.xpath(path, namespaces=NSFEED)[0]
+        return self.xpath(path)[0]
 
     def xpath_date(self, path):
         """
         @rtype: datetime
         """
-        return parse(self.xpath_value(path))
+        return parse_date(self.xpath_value(path))
 
     def __getitem__(self, item):
         return self.tree.__getitem__(item)
@@ -48,105 +127,321 @@ class BloggerToBook(object):
         None: 'http://www.gribuser.ru/xml/fictionbook/2.0',
         #'xlink': 'http://www.w3.org/1999/xlink',
     }
+    # entries queued per worker process
+    IN_FLIGHT = 4
 
     def __init__(self, stream, genre, lang, **options):
         """
-        @type stream: file
+        @param stream: feed file or an iterable of feed page files
         @type genre: list
         @type lang: str
         """
-        _logger.debug('Parsing stream')
-        tree = TreeWrapper(etree.parse(stream))
+        self.genre = genre
+        self.lang = lang
+        self.jobs = options.get('jobs') or 1
+        # a process pool shared with other books, see batch.py
+        self.pool = options.get('pool')
+        # otherwise the book forks its own before the first page starts the
+        # fetcher threads, it is terminated once the entries are converted
+        self._own_pool = None
+        if self.pool is None and self.jobs > 1:
+            self.pool = self._own_pool = multiprocessing.Pool(self.jobs)
+        self.cache = options.get('section_cache')
+        self.images = options.get('image_store')
+        self.stats = options.get('stats') or NULL_STATS
+        # passed on to convert, rules are names: the options go to pool workers
+        prune = options.get('prune')
+        self.convert_options = {
+            'engine': options.get('engine') or HtmlToFb.SAX,
+            'images': self.images is not None,
+            'prune': tuple(DEFAULT_RULES if prune is None else prune),
+        }
 
-        _logger.debug('Preparing header')
+        _logger.debug('Parsing stream')
 
-        self.book = etree.Element("FictionBook", nsmap=self.NSMAP)
+        self._entries = self._parse([stream] if hasattr(stream, 'read') else stream)
+        try:
+            # parsing stops at the first entry, so the header is ready before any
+            # entry is converted
+            self.root = TreeWrapper(next(self._entries))
+            # feed update time as Blogger wrote it
+            self.updated = self.root.xpath_value(FEED_UPDATED)
 
-        name = tree.xpath_value('/a:feed/a:author/a:name/text()')
-        firstName, lastName = re.split('\s+', name, 1)
-        email = tree.xpath_value('/a:feed/a:author/a:email/text()')
-        homePage = tree.xpath_value('/a:feed/a:author/a:uri/text()')
-        bookTitle= tree.xpath_value('/a:feed/a:title/text()')
-        annotation= tree.xpath_value('/a:feed/a:subtitle/text()')
+            _logger.debug('Preparing header')
 
-        bookId = tree.xpath_value('/a:feed/a:id/text()')
+            self.description, self.title = self._header(self.root)
+        except Exception:
+            if self._own_pool is not None:
+                self._own_pool.terminate()
+                self._own_pool.join()
+            raise
 
-        sourceUrl = tree.xpath_value('/a:feed/a:link[@rel="alternate" and @type="text/html" and @href]/@href')
+    def _parse(self, pages):
+        """
+        Yields the feed root once its header is parsed and then every entry.
+        Entries are dropped from the tree once they have been consumed, so
+        only the feed header stays in memory.
+        """
+        root = None
+        for page in pages:
+            context = etree.iterparse(page, events=('start', 'end'), tag=ENTRY_TAG)
+            for event, entry in context:
+                if event == 'start':
+                    if root is None:
+                        root = entry.getparent()
+                        yield root
+                    continue
+
+                yield entry
+                entry.clear()
+                entry.getparent().remove(entry)
+
+            # the header is taken from the first page
+            if root is None:
+                root = context.root
+                yield root
+
+    def _header(self, tree, volume=None, label=None):
+        """
+        @type tree: TreeWrapper
+        @param volume: volume number, None for a single book
+        @param label: volume title suffix
+        @return: description and body title elements
+        """
+        author = (
+            tree.xpath_value(FEED_AUTHOR_NAME),
+            tree.xpath_value(FEED_AUTHOR_EMAIL),
+            tree.xpath_value(FEED_AUTHOR_URI),
+        )
+        return self._describe([author], tree.xpath_value(FEED_TITLE), [tree.xpath_value(FEED_SUBTITLE)],
+                              tree.xpath_value(FEED_ID), [tree.xpath_value(FEED_LINK)], tree.xpath_date(FEED_UPDATED),
+                              volume, label)
 
-        date = tree.xpath_date('/a:feed/a:updated/text()')
+    def _describe(self, authors, bookTitle, annotation, bookId, sourceUrls, date, volume=None, label=None):
+        """
+        @param authors: name, email and home page of every author
+        @param annotation: annotation paragraphs
+        @param sourceUrls: where the book comes from
+        @param date: last update of the sources
+        @type date: datetime
+        @return: description and body title elements
+        """
         bookVersion = '%d' % time.mktime(date.timetuple())
 
-        titleInfoItems = [self._e('genre', x) for x in genre]
+        seriesTitle = bookTitle
+        if volume is not None:
+            bookTitle = '%s, %s' % (bookTitle, label)
+            bookId = '%s/%d' % (bookId, volume)
+
+        titleInfoItems = [self._e('genre', x) for x in self.genre]
+
+        for name, email, homePage in authors:
+            firstName, lastName = re.split('\s+', name, 1)
+            titleInfoItems.append(
+                self._e('author', None,
+                    self._e('first-name', firstName),
+                    self._e('last-name', lastName),
+                    self._e('home-page', homePage),
+                    self._e('email', email),
+                )
+            )
 
         titleInfoItems += [
-            self._e('author', None,
-                self._e('first-name', firstName),
-                self._e('last-name', lastName),
-                self._e('home-page', homePage),
-                self._e('email', email),
-            ),
             self._e('book-title', bookTitle),
             self._e('annotation', None,
-                self._e('p', annotation)
+                *[self._e('p', p) for p in annotation]
             ),
             self._e('date', date.strftime('%Y'), value=date.strftime("%Y-%m-%d")),
-            self._e('lang', lang),
-            self._e('src-lang', lang),
+            self._e('lang', self.lang),
+            self._e('src-lang', self.lang),
         ]
 
+        if volume is not None:
+            titleInfoItems.append(self._e('sequence', None, name=seriesTitle, number=str(volume)))
+
         description = self._e('description', None,
             self._e('title-info', None,
                 *titleInfoItems
             ),
             self._e('document-info', None,
-                self._e('author', None,
-                    self._e('nickname', getpass.getuser()),
-                ),
-                self._e('program-used', PROGRAM_NAME),
-                self._e('date', datetime.today().strftime("%d %B, %Y"), value=datetime.today().strftime("%Y-%m-%d")),
-                self._e('src-url', sourceUrl),
-                self._e('id', bookId),
-                self._e('version', bookVersion),
+                *[
+                    self._e('author', None,
+                        self._e('nickname', getpass.getuser()),
+                    ),
+                    self._e('program-used', PROGRAM_NAME),
+                    self._e('date', datetime.today().strftime("%d %B, %Y"), value=datetime.today().strftime("%Y-%m-%d")),
+                ] + [self._e('src-url', url) for url in sourceUrls] + [
+                    self._e('id', bookId),
+                    self._e('version', bookVersion),
+                ]
             )
         )
 
-        self.book.append(description)
-
-        body = self._e('body', None,
-            self._e('title', None,
-                self._e('p', name),
-                self._e('p', bookTitle),
-            )
+        title = self._e('title', None,
+            *[self._e('p', name) for name, _email, _homePage in authors] + [self._e('p', bookTitle)]
         )
 
+        return description, title
+
+    def sections(self):
+        """
+        Converts feed entries into sections.
+        Yields entry key, publishing date and section, oldest first.
+        """
         _logger.debug('Parsing entries')
 
-        for entry in reversed(tree.xpath('/a:feed/a:entry')):
-            entry = TreeWrapper(entry)
-            title = entry.xpath_value('./a:title/text()')
-            published = entry.xpath_date('./a:published/text()')
+        published = deque()
+        def remember(entries):
+            for key, fields in entries:
+                published.append((key, fields[1]))
+                yield key, fields
+
+        entries = remember(self.entry_fields(TreeWrapper(entry)) for entry in self._timed_entries())
+        if self.pool is not None:
+            converted = self._convert_parallel(entries)
+        else:
+            converted = (self._convert(key, fields) for key, fields in entries)
+
+        spool = SectionSpool()
+        try:
+            for section in converted:
+                # images are downloaded while the remaining entries are converted
+                if self.images is not None:
+                    self.images.register(section)
+                key, date = published.popleft()
+                with self.stats.timer('spool'):
+                    spool.append(key, date, section)
+
+            # Blogger returns entries newest first
+            for item in spool.replay():
+                yield item
+        finally:
+            spool.close()
+
+    def _timed_entries(self):
+        """
+        Feed entries, the time spent waiting for them is accounted as feed parsing
+        """
+        while True:
+            with self.stats.timer('feed_parse'):
+                entry = next(self._entries, None)
+            if entry is None:
+                return
+
+            self.stats.count('entries')
+            yield entry
+
+    def _convert(self, key, fields):
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.stats.count('cached_entries')
+                return etree.fromstring(cached)
+
+        section = self.convert(*fields, stats=self.stats, **self.convert_options)
+        if self.cache is not None:
+            self.cache.put(key, etree.tostring(section))
 
-            content = entry.xpath_value('./a:content/text()')
-            _logger.debug('%s %d bytes long' % (title, len(content)))
+        return section
+
+    def _convert_parallel(self, entries):
+        """
+        Converts entries in a process pool, yielding sections in feed order.
+        Only a few entries per worker are in flight at once.
+        """
+        try:
+            pending = deque()
+            for key, fields in entries:
+                cached = self.cache.get(key) if self.cache is not None else None
+                result = self.pool.apply_async(_convert_serialized, (fields, self.convert_options)) if cached is None else None
+                pending.append((key, cached, result))
+                if len(pending) >= self.jobs * self.IN_FLIGHT:
+                    yield self._collect(*pending.popleft())
+
+            while pending:
+                yield self._collect(*pending.popleft())
+        finally:
+            if self._own_pool is not None:
+                self._own_pool.terminate()
+                self._own_pool.join()
+                self.pool = self._own_pool = None
+
+    def _collect(self, key, cached, result):
+        if cached is None:
+            # conversion itself happens in the workers and is not accounted
+            with self.stats.timer('pool_wait'):
+                cached = result.get()
+            if self.cache is not None:
+                self.cache.put(key, cached)
+
+        return etree.fromstring(cached)
+
+    @classmethod
+    def entry_fields(cls, entry):
+        """
+        @type entry: TreeWrapper
+        @return: cache key of the entry, its title, publishing date and html content
+        """
+        key = (
+            unicode(entry.xpath_value(ENTRY_ID)),
+            unicode(entry.xpath_value(ENTRY_UPDATED)),
+        )
+        return key, (
+            entry.xpath_value(ENTRY_TITLE),
+            entry.xpath_date(ENTRY_PUBLISHED),
+            entry.xpath_value(ENTRY_CONTENT),
+        )
+
+    @classmethod
+    def convert(cls, title, published, content, author=None, stats=NULL_STATS, prune=(), **convert_options):
+        """
+        @type title: unicode
+        @type published: datetime
+        @type content: unicode
+        @param author: shown under the title, for books collecting several blogs
+        @type stats: stats.Stats
+        @param prune: names of prune.RULES removing subtrees before the conversion
+        @param convert_options: HtmlToFb keyword arguments
+        @rtype: lxml.etree._Element
+        """
+        started = time.time()
+        size = len(content)
+        _logger.debug('%s %d bytes long' % (title, size))
+        with stats.timer('html_parse'):
             content = etree.HTML(content)
 
-            section = self._e('section', None,
-                self._e('title', None,
-                    self._e('p', title)
-                ),
-                self._e('subtitle', published.strftime('%d %B, %Y')
-                )
+        if prune:
+            with stats.timer('prune'):
+                pruned = pruner(prune).prune(content)
+            if pruned:
+                _logger.debug('%s: %d nodes pruned' % (title, pruned))
+                stats.count('pruned_nodes', pruned)
+
+        section = cls._e('section', None,
+            cls._e('title', None,
+                cls._e('p', title)
+            ),
+            cls._e('subtitle', published.strftime('%d %B, %Y')
             )
+        )
+        if author is not None:
+            section[0].addnext(cls._e('subtitle', author))
 
-            for bit in HtmlToFb(content).get_tree():
+        with stats.timer('convert'):
+            converter = HtmlToFb(content, lazy=True, **convert_options)
+            for bit in converter.blocks():
                 section.append(bit)
 
-            body.append(section)
+        if stats is not NULL_STATS:
+            stats.count('input_bytes', size)
+            stats.count('sax_events', converter.events)
+            stats.count('output_elements', sum(1 for _e in section.iter()))
+            stats.entry(title, time.time() - started, size)
 
-        self.book.append(body)
-        _logger.debug('Book parsed')
+        return section
 
-    def _e(self, tag, content, *children, **attrib):
+    @staticmethod
+    def _e(tag, content, *children, **attrib):
         e = etree.Element(tag, attrib)
         if content is not None:
             e.text = content
@@ -158,61 +453,433 @@ class BloggerToBook(object):
 
     def write(self, binary_stream):
         """
+        Writes the book out section by section, the header goes out before
+        any entry is converted
+
         @type binary_stream: file
         """
-        xml = etree.tostring(self.book, xml_declaration=True, encoding='utf-8', pretty_print=True)
-        # print xml
-        binary_stream.write(xml)
+        self._write_book(binary_stream, self.description, self.title, self.sections())
+        _logger.debug('Book written')
 
-if __name__ == '__main__':
-    import sys
-    import optparse
-    import logging
+    def write_indexed(self, binary_stream, index):
+        """
+        Writes the book remembering where its parts are, see sync.py
 
-    parser = optparse.OptionParser()
+        @type binary_stream: file
+        @type index: sync.BookIndex
+        """
+        index.updated = self.updated
+        index.images = self.images is not None
+        self._write_book(binary_stream, self.description, self.title, self.sections(), index=index)
+        _logger.debug('Book written')
+
+    def nsmap(self):
+        return self.NSMAP if self.images is None else dict(self.NSMAP, xlink=XLINK)
+
+    def write_volumes(self, open_volume, entries=None, size=None, by_year=False):
+        """
+        Splits the book into volumes. Every volume gets its own id, title and
+        sequence number, and is finished before the next one is started.
+
+        @param open_volume: called with the volume number, returns a context
+            manager giving the binary stream of the volume
+        @param entries: maximal number of sections per volume
+        @param size: volume size, in bytes, after which no more sections are added
+        @param by_year: start a new volume for every year
+        @return: number of volumes written
+        """
+        sections = self.sections()
+        pending = next(sections, None)
+        volume = 0
+        while pending is not None:
+            volume += 1
+            year = pending[1].year
+            label = '%d' % year if by_year else 'vol. %d' % volume
+
+            def fits(count, written, published):
+                if entries and count >= entries:
+                    return False
+                if size and written >= size:
+                    return False
+                return not by_year or published.year == year
+
+            description, title = self._header(self.root, volume, label)
+            with open_volume(volume) as binary_stream:
+                pending = self._write_book(binary_stream, description, title, sections, pending, fits)
+            _logger.debug('Volume %d written' % volume)
+
+        return volume
+
+    def _write_book(self, binary_stream, description, title, sections, first=None, fits=None, index=None):
+        """
+        @param sections: iterator over entry key, publishing date and section
+        @param first: an item already taken from sections
+        @param fits: fits(sections written, bytes written, publishing date)
+            tells whether one more section goes into the book
+        @param index: records byte offsets of the sections
+        @type index: sync.BookIndex
+        @return: the item that did not fit, None once sections are exhausted
+        """
+        if fits is not None or index is not None:
+            binary_stream = CountingStream(binary_stream)
+
+        # images referenced by the written sections
+        self.binaries = {}
+        with etree.xmlfile(binary_stream, encoding='utf-8') as xf:
+            xf.write_declaration()
+            with xf.element('FictionBook', nsmap=self.nsmap()):
+                self._write_block(xf, description, 1)
+                xf.flush()
+                if index is not None:
+                    index.header_end = binary_stream.size
+                xf.write('\n  ')
+                with xf.element('body'):
+                    self._write_block(xf, title, 2)
+                    pending = first if first is not None else next(sections, None)
+                    count = 0
+                    while pending is not None:
+                        key, published, section = pending
+                        if fits is not None or index is not None:
+                            xf.flush()
+                            if count and fits is not None and not fits(count, binary_stream.size, published):
+                                break
+                            start = binary_stream.size
+
+                        if self.images is not None:
+                            self.binaries.update(self.images.resolve(section))
+                        # sections hold mixed content and are never reindented
+                        with self.stats.timer('serialize'):
+                            xf.write('\n    ', section)
+                        if index is not None:
+                            xf.flush()
+                            index.add(key, start, binary_stream.size)
+                        count += 1
+                        pending = next(sections, None)
+                    if index is not None:
+                        xf.flush()
+                        index.body_end = binary_stream.size
+                    xf.write('\n  ')
+                if self.images is not None:
+                    self.images.write_binaries(xf, self.binaries, '\n  ')
+                if index is not None:
+                    xf.flush()
+                    index.binaries_end = binary_stream.size
+                    index.binaries.update(self.binaries)
+                xf.write('\n')
+        binary_stream.write('\n')
+        return pending
+
+    @classmethod
+    def _write_block(cls, xf, element, level):
+        # same layout pretty printing the whole book at once used to produce
+        etree.indent(element, level=level)
+        xf.write('\n' + '  ' * level, element)
+
+class SectionSpool(object):
+    """
+    Converted sections kept serialized in a temporary file, which stays in
+    memory while it is small. Only entry keys, dates and offsets are held
+    otherwise, so a long feed is converted as it streams in and written out
+    in reverse without every section in memory.
+    """
+    # 8 MiB
+    MEMORY_SIZE = 8 << 20
+
+    def __init__(self, memory_size=MEMORY_SIZE):
+        """
+        @param memory_size: sections are moved to disk once they outgrow it, in bytes
+        """
+        self.file = tempfile.SpooledTemporaryFile(max_size=memory_size)
+        # entry key, publishing date, offset and size of each section
+        self.items = []
+        self.size = 0
+
+    def append(self, key, published, section):
+        """
+        @type section: lxml.etree._Element
+        """
+        data = etree.tostring(section)
+        self.file.write(data)
+        self.items.append((key, published, self.size, len(data)))
+        self.size += len(data)
+
+    def replay(self):
+        """
+        Yields entry key, publishing date and section, the last appended
+        first. Replayed sections are cut off the file.
+        """
+        while self.items:
+            key, published, offset, size = self.items.pop()
+            self.file.seek(offset)
+            data = self.file.read(size)
+            self.file.seek(offset)
+            self.file.truncate()
+            self.size = offset
+            yield key, published, etree.fromstring(data)
+
+    def close(self):
+        self.file.close()
+
+class CountingStream(object):
+    """
+    Output stream wrapper counting written bytes
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        self.stream.write(data)
+
+def volume_path(path, volume):
+    """
+    book.fb2.zip -> book.2.fb2.zip
+    """
+    head, ext, tail = path.rpartition('.fb2')
+    if not ext:
+        return '%s.%d' % (path, volume)
+    return '%s.%d%s%s' % (head, volume, ext, tail)
+
+def open_source(spec, fetch_workers=BlogspotFetcher.WORKERS, cache=None, stats=None, updated_min=None):
+    """
+    @param spec: local file path or blogspot:<name>
+    @type cache: HttpCache
+    @type stats: stats.Stats
+    @param updated_min: only entries changed since, local files are read whole
+    @return: a feed stream or an iterable of page streams
+    """
+    if os.path.exists(spec):
+        _logger.info('Reading local file: %s' % spec)
+        return open(spec)
+
+    source, name = spec.split(':', 1)
+    if source == 'blogspot':
+        _logger.info('Loading %s from blogspot' % name)
+        fetcher = BlogspotFetcher(name, workers=fetch_workers, cache=cache, stats=stats, updated_min=updated_min)
+        _logger.info('Retirieving number of results')
+        results = fetcher.total()
+        _logger.info('%d items found' % results)
+        _logger.info('Retirieving items')
+        return fetcher.pages(results)
+
+    _logger.error('Invalid command: %s' % source)
+    return open(spec)
+
+def add_conversion_options(parser):
+    """
+    Options shared by the command line tools: the caches, the html engine
+    and the pruning rules
+
+    @type parser: optparse.OptionParser
+    """
+    parser.add_option("--cache-dir", action="store", dest='cache_dir', default=None,
+                      help='directory for the persistent http cache')
+    parser.add_option("--cache-size", action="store", type="int", dest='cache_size',
+                      default=HttpCache.MAX_SIZE >> 20, help='http cache size limit, MiB')
+    parser.add_option("--section-cache", action="store", dest='section_cache_path', default=None,
+                      help='sqlite file caching converted entries between runs')
+    parser.add_option("-e", "--engine", action="store", dest='engine', default=HtmlToFb.SAX,
+                      choices=HtmlToFb.ENGINES, help='html conversion engine: %s' % ', '.join(HtmlToFb.ENGINES))
+    parser.add_option("--prune", action="store", dest='prune_rules', default=','.join(DEFAULT_RULES),
+                      help='comma separated subtrees removed from posts before the conversion, '
+                           'empty to keep everything: %s' % ', '.join(PRUNE_RULES))
+
+def add_book_options(parser):
+    """
+    Options of the tools writing a book of their own: genres, language and
+    compression
+
+    @type parser: optparse.OptionParser
+    """
     parser.add_option("-g", "--genre", action="append", dest='genre', default=[], help='fb2.1 genre list')
     parser.add_option("-l", "--lang", action="store", dest='lang', default='en', help='book language')
-
+    parser.add_option("-z", "--compress", action="store", dest='compress', default=None, choices=COMPRESSIONS,
+                      help='compress the book: %s, by default taken from the output extension' % ', '.join(COMPRESSIONS))
+
+def add_worker_options(parser, per=None, shared_by=None):
+    """
+    Page downloads and processes converting entries
+
+    @type parser: optparse.OptionParser
+    @param per: what the page downloads are counted for, e.g. 'blog'
+    @param shared_by: what shares the processes, e.g. 'books'
+    """
+    parser.add_option("-w", "--fetch-workers", action="store", type="int", dest='fetch_workers',
+                      default=BlogspotFetcher.WORKERS,
+                      help='number of parallel page downloads' + (' per %s' % per if per else ''))
+    parser.add_option("-j", "--jobs", action="store", type="int", dest='jobs', default=1,
+                      help='number of processes converting entries' + (', shared by all %s' % shared_by if shared_by else ''))
+
+def add_image_options(parser):
+    """
+    @type parser: optparse.OptionParser
+    """
+    parser.add_option("--images", action="store", dest='image_dir', default=None,
+                      help='embed images, keeping downloaded ones in this directory')
+    parser.add_option("--image-workers", action="store", type="int", dest='image_workers',
+                      default=ImageStore.WORKERS, help='number of parallel image downloads')
+
+def parse_prune(parser, options):
+    """
+    Pruning rules given with --prune, the parser exits on unknown ones
+
+    @type parser: optparse.OptionParser
+    @rtype: list
+    """
+    prune = [name for name in options.prune_rules.split(',') if name]
+    unknown = [name for name in prune if name not in PRUNE_RULES]
+    if unknown:
+        parser.error('unknown pruning rules: %s' % ', '.join(unknown))
+    return prune
+
+def setup_logging(level=logging.INFO):
+    """
+    Logs of all modules go to stderr
+
+    @rtype: logging.Logger
+    """
     log = logging.getLogger('feed-fb2')
     frmttr = logging.Formatter('%(asctime)s %(name)s %(levelname)s %(message)s', '%Y-%m-%d %H:%M:%S')
     shdlr = logging.StreamHandler(sys.stderr)
     shdlr.setFormatter(frmttr)
     log.addHandler(shdlr)
-    log.setLevel(logging.DEBUG)
+    log.setLevel(level)
+    return log
+
+def _convert_serialized(fields, convert_options):
+    # pool workers hand sections back as xml, elements can not be pickled
+    return etree.tostring(BloggerToBook.convert(*fields, **convert_options))
+
+if __name__ == '__main__':
+    import optparse
+    from contextlib import contextmanager
+
+    parser = optparse.OptionParser()
+    add_book_options(parser)
+    add_worker_options(parser)
+    add_conversion_options(parser)
+    add_image_options(parser)
+    parser.add_option("--volume-entries", action="store", type="int", dest='volume_entries', default=None,
+                      help='split the book into volumes of this many entries')
+    parser.add_option("--volume-size", action="store", type="int", dest='volume_size', default=None,
+                      help='split the book into volumes of about this size, MiB')
+    parser.add_option("--volume-by-year", action="store_true", dest='volume_by_year', default=False,
+                      help='split the book into a volume per year')
+    parser.add_option("--sync", action="store_true", dest='sync', default=False,
+                      help='update the book converted before with the changed entries only')
+    parser.add_option("--stats", action="store", dest='stats_path', default=None,
+                      help='write stage timings and counters as json to this file, - for stderr')
+    parser.add_option("--profile", action="store", dest='profile_path', default=None,
+                      help='run under cProfile and save the profile to this file')
+
+    log = setup_logging(logging.DEBUG)
 
     options, args = parser.parse_args()
     if not options.genre:
         options.genre = ['ref_ref']
 
-    if os.path.exists(args[0]):
-        log.info('Reading local file: %s' % args[0])
-        stream = open(args[0])
-    else:
-        source, name = args[0].split(':', 1)
-        if source == 'blogspot':
-            log.info('Loading %s from blogspot' % name)
-            url = 'http://%s.blogspot.com/feeds/posts/default/?max-results=0' % name
-            log.info('Retirieving number of results')
-            tree = etree.parse(urlopen(url))
-            results = int(tree.xpath('/a:feed/s:totalResults/text()', namespaces=NSFEED)[0])
-            log.info('%d items found' % results)
-            log.info('Retirieving items')
-            url = 'http://%s.blogspot.com/feeds/posts/default/?max-results=%d' % (name, results)
-            stream = urlopen(url)
-        else:
-            log.error('Invalid command: %s' % source)
-            stream = open(args[0])
+    options.prune = parse_prune(parser, options)
+
+    volumes = options.volume_entries or options.volume_size or options.volume_by_year
+    if volumes and args[1] == '-':
+        parser.error('volumes cannot be written into STDOUT')
+
+    index = None
+    if options.sync:
+        from sync import BookIndex, sync_book
+        if volumes or args[1] == '-' or options.compress or compression_for(args[1]):
+            parser.error('only an uncompressed single book can be synced')
+        index_path = BookIndex.path_for(args[1])
+        if os.path.exists(args[1]) and os.path.exists(index_path):
+            try:
+                index = BookIndex.load(index_path)
+            except (ValueError, KeyError):
+                log.warning('%s is unreadable, converting in full' % index_path)
+            else:
+                if not index.matches(args[1]):
+                    log.warning('%s changed since it was indexed, converting in full' % args[1])
+                    index = None
+                elif index.images != bool(options.image_dir):
+                    log.warning('%s was converted %s images, converting in full' % (
+                        args[1], 'with' if index.images else 'without'))
+                    index = None
+
+    if options.stats_path:
+        options.stats = Stats()
+
+    if options.profile_path:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+
+    # the process pool is forked before the fetcher and image threads start
+    options.pool = multiprocessing.Pool(options.jobs) if options.jobs > 1 else None
+
+    cache = HttpCache(options.cache_dir, options.cache_size << 20) if options.cache_dir else None
+    stream = open_source(args[0], options.fetch_workers, cache, getattr(options, 'stats', None),
+                         index.updated if index is not None else None)
+
+    if options.image_dir:
+        options.image_store = ImageStore(options.image_dir, options.image_workers)
+
+    if options.section_cache_path:
+        version = converter_version(bool(options.image_dir), options.engine, options.prune)
+        options.section_cache = SectionCache(options.section_cache_path, version)
 
     log.info('Parsing')
     b2b = BloggerToBook(stream, **options.__dict__)
-    if args[1] == '-':
-        o = sys.stdout
-        log.info('Book dumped into STDOUT')
-    else:
-        o = open(args[1], 'wb')
+    compression = options.compress or compression_for(args[1])
+
+    @contextmanager
+    def output(path):
+        o = sys.stdout if path == '-' else open(path, 'wb')
+        out = compressed(o, compression, entry_name(path) if path != '-' else 'book.fb2')
+        yield TimedStream(out, options.stats) if options.stats_path else out
+        if out is not o:
+            out.close()
+        o.close()
+
+    if index is not None:
+        if sync_book(b2b, args[1], index):
+            index.save(index_path)
+            log.info('Book updated in %s' % args[1])
+    elif options.sync:
+        index = BookIndex()
+        with output(args[1]) as out:
+            b2b.write_indexed(out, index)
+        index.stamp(args[1])
+        index.save(index_path)
         log.info('Book saved into %s' % args[1])
+    elif volumes:
+        count = b2b.write_volumes(lambda volume: output(volume_path(args[1], volume)),
+                                  options.volume_entries, options.volume_size and options.volume_size << 20,
+                                  options.volume_by_year)
+        log.info('Book saved into %d volumes next to %s' % (count, args[1]))
+    else:
+        with output(args[1]) as out:
+            b2b.write(out)
+        log.info('Book dumped into STDOUT' if args[1] == '-' else 'Book saved into %s' % args[1])
+
+    if options.pool is not None:
+        options.pool.terminate()
+        options.pool.join()
+
+    if options.profile_path:
+        profile.disable()
+        profile.dump_stats(options.profile_path)
+
+    if options.stats_path:
+        if options.stats_path == '-':
+            options.stats.dump(sys.stderr)
+        else:
+            with open(options.stats_path, 'w') as f:
+                options.stats.dump(f)
+
+    if options.section_cache_path:
+        options.section_cache.close()
 
-    b2b.write(o)
-    o.close()
+    if options.image_dir:
+        options.image_store.close()
 
     log.info('Done')
@@ -0,0 +1,117 @@
+import gzip
+import os
+import struct
+import time
+import zlib
+
+ZIP = 'zip'
+GZIP = 'gzip'
+COMPRESSIONS = [ZIP, GZIP]
+
+class ZipEntryWriter(object):
+    """
+    Writes a single-entry zip archive on the fly.
+
+    The entry is deflated as data comes in and its crc and sizes follow the
+    data in a descriptor, so the output does not have to be seekable and is
+    never written twice. Zip64 is not supported, the entry has to stay
+    below 4 GiB.
+    """
+    # general purpose flags: sizes and crc follow the data, utf-8 name
+    FLAGS = 0x0008 | 0x0800
+    VERSION = 20
+    DEFLATED = 8
+
+    def __init__(self, stream, name, level=zlib.Z_DEFAULT_COMPRESSION):
+        """
+        @type stream: file
+        @param name: name of the entry inside the archive
+        @type name: str
+        """
+        self.stream = stream
+        self.name = name.encode('utf-8') if isinstance(name, unicode) else name
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.crc = 0
+        self.size = 0
+        self.compressed = 0
+        self.closed = False
+
+        t = time.localtime()
+        self.dostime = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+        self.dosdate = (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+
+        self.stream.write(struct.pack('<4s5H3L2H', 'PK\x03\x04', self.VERSION, self.FLAGS, self.DEFLATED,
+                                      self.dostime, self.dosdate, 0, 0, 0, len(self.name), 0))
+        self.stream.write(self.name)
+        self.header_size = 30 + len(self.name)
+
+    def write(self, data):
+        if not data:
+            return
+
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self._out(self.compressor.compress(data))
+
+    def _out(self, data):
+        if data:
+            self.compressed += len(data)
+            self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        self._out(self.compressor.flush())
+        crc = self.crc & 0xffffffff
+        self.stream.write(struct.pack('<4s3L', 'PK\x07\x08', crc, self.compressed, self.size))
+
+        directory = self.header_size + self.compressed + 16
+        entry = struct.pack('<4s6H3L5H2L', 'PK\x01\x02', self.VERSION, self.VERSION, self.FLAGS, self.DEFLATED,
+                            self.dostime, self.dosdate, crc, self.compressed, self.size,
+                            len(self.name), 0, 0, 0, 0, 0, 0) + self.name
+        self.stream.write(entry)
+        self.stream.write(struct.pack('<4s4H2LH', 'PK\x05\x06', 0, 0, 1, 1, len(entry), directory, 0))
+
+def compression_for(path):
+    """
+    Compression implied by the output file name
+
+    @type path: str
+    """
+    if path.endswith('.zip'):
+        return ZIP
+    if path.endswith('.gz'):
+        return GZIP
+    return None
+
+def compressed(stream, compression, name='book.fb2'):
+    """
+    Wraps a binary stream so that everything written into it is compressed.
+    The wrapper has to be closed to finish the archive, the stream itself
+    is left open.
+
+    @param compression: one of COMPRESSIONS or None
+    @param name: file name stored in the archive
+    """
+    if compression == ZIP:
+        return ZipEntryWriter(stream, name)
+    if compression == GZIP:
+        return gzip.GzipFile(filename=name, mode='wb', fileobj=stream)
+    return stream
+
+def entry_name(path):
+    """
+    Book file name inside an archive written to path
+    """
+    name = os.path.basename(path)
+    for ext in ('.zip', '.gz'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    if not name.endswith('.fb2'):
+        name += '.fb2'
+    return name
@@ -0,0 +1,460 @@
+from cStringIO import StringIO
+import httplib
+from lxml import etree
+import socket
+import threading
+import time
+from urllib import urlencode
+from urlparse import urlsplit
+import zlib
+import logging
+
+_logger = logging.getLogger('feed-fb2.fetcher')
+_logger.addHandler(logging.NullHandler())
+
+NSFEED = {
+    'a': 'http://www.w3.org/2005/Atom',
+    's': 'http://a9.com/-/spec/opensearchrss/1.0/',
+}
+
+TOTAL_RESULTS = etree.XPath('/a:feed/s:totalResults/text()', namespaces=NSFEED)
+UPDATED = etree.XPath('/a:feed/a:updated/text()', namespaces=NSFEED)
+
+class FetchError(Exception):
+    pass
+
+class GzipStream(object):
+    """
+    Decompresses a gzip stream as it is read, so that the parser gets the
+    feed without the whole decompressed body being held in memory
+    """
+    CHUNK = 1 << 16
+
+    def __init__(self, stream):
+        """
+        @param stream: compressed data, anything with read(size)
+        """
+        self.stream = stream
+        # 16 + window bits: gzip header and trailer
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = ''
+        self.eof = False
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            chunk = self.stream.read(self.CHUNK)
+            if chunk:
+                self.buffer += self.decompressor.decompress(chunk)
+            else:
+                self.buffer += self.decompressor.flush()
+                self.eof = True
+
+        if size < 0 or size >= len(self.buffer):
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.stream.close()
+
+def decoded(stream, encoding):
+    """
+    @param stream: response body as sent by the server
+    @param encoding: value of its Content-Encoding header
+    @return: readable stream of the decoded body
+    """
+    if encoding == 'gzip':
+        return GzipStream(stream)
+    if encoding not in (None, 'identity'):
+        raise FetchError('Unsupported content encoding: %s' % encoding)
+    return stream
+
+class KeepAliveClient(object):
+    """
+    Issues GET requests over one persistent connection per thread
+    """
+    RETRIES = 2
+
+    def __init__(self, base_url, timeout=60, cache=None):
+        """
+        @type base_url: str
+        @type cache: httpcache.HttpCache
+        """
+        parts = urlsplit(base_url)
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.cache = cache
+        self.local = threading.local()
+
+    def _connection(self, fresh=False):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and fresh:
+            conn.close()
+            conn = None
+
+        if conn is None:
+            conn = self.local.conn = self._new_connection()
+
+        return conn
+
+    def _new_connection(self):
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def _url(self, path, query):
+        url = self.prefix + path
+        if query:
+            url += '?' + urlencode(sorted(query.items()))
+        return url
+
+    def get(self, path, query=None, headers=None):
+        """
+        @type path: str
+        @type query: dict
+        @return: decoded response body
+        @rtype: str
+        """
+        body, encoding = self.fetch(path, query, headers)
+        return decoded(StringIO(body), encoding).read()
+
+    def fetch(self, path, query=None, headers=None):
+        """
+        Response body as sent by the server, gzip compressed if the server
+        supports it. Compressed bodies are stored in the cache as they are.
+
+        @type path: str
+        @type query: dict
+        @return: body and its content encoding
+        """
+        url = self._url(path, query)
+        headers = dict(headers or {}, **{'Accept-Encoding': 'gzip'})
+        validators = {}
+        if self.cache is not None:
+            cache_key = '%s://%s%s' % (self.scheme, self.netloc, url)
+            validators = self.cache.validators(cache_key)
+
+        for attempt in range(self.RETRIES):
+            conn = self._connection(fresh=bool(attempt))
+            try:
+                conn.request('GET', url, headers=dict(headers, **validators))
+                response = conn.getresponse()
+                # the body has to be read completely before the connection can be reused
+                body = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                # the server may have dropped an idle keep-alive connection
+                _logger.debug('Reconnecting after %r on %s' % (e, url))
+                continue
+
+            if response.status == 304 and self.cache is not None:
+                try:
+                    return self.cache.load(cache_key)
+                except (IOError, OSError, ValueError), e:
+                    # evicted by another thread since the validators were taken
+                    _logger.debug('Refetching %s after %r' % (url, e))
+                    validators = {}
+                    continue
+
+            if response.status != 200:
+                raise FetchError('%s returned %d %s' % (url, response.status, response.reason))
+
+            if self.cache is not None:
+                self.cache.store(cache_key, response.getheaders(), body)
+
+            return body, response.getheader('content-encoding')
+
+        raise FetchError('Unable to retrieve %s' % url)
+
+    def open(self, path, query=None, headers=None):
+        """
+        Streams the response body over a connection of its own, the body is
+        decoded while it is read. The connection is closed by the server once
+        the body is read, the stream has to be read to the end or closed.
+
+        @type path: str
+        @type query: dict
+        @return: readable stream of the decoded body
+        """
+        url = self._url(path, query)
+        headers = dict(headers or {}, **{'Accept-Encoding': 'gzip', 'Connection': 'close'})
+
+        for _attempt in range(self.RETRIES):
+            conn = self._new_connection()
+            try:
+                conn.request('GET', url, headers=headers)
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error), e:
+                _logger.debug('Reconnecting after %r on %s' % (e, url))
+                conn.close()
+                continue
+
+            if response.status != 200:
+                conn.close()
+                raise FetchError('%s returned %d %s' % (url, response.status, response.reason))
+
+            return decoded(response, response.getheader('content-encoding'))
+
+        raise FetchError('Unable to retrieve %s' % url)
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+class BlogspotFetcher(object):
+    """
+    Downloads a blog feed as a series of start-index/max-results pages
+    """
+    BASE_URL = 'http://%s.blogspot.com'
+    FEED_PATH = '/feeds/posts/default/'
+    # Blogger does not return more than 500 entries per request
+    PAGE_SIZE = 500
+    WORKERS = 4
+
+    def __init__(self, name, workers=WORKERS, page_size=PAGE_SIZE, base_url=None, cache=None, stats=None,
+                 updated_min=None):
+        """
+        @type name: str
+        @type workers: int
+        @type page_size: int
+        @param base_url: feed host, e.g. a local stand-in server
+        @type cache: httpcache.HttpCache
+        @param stats: download time is summed over all workers
+        @type stats: stats.Stats
+        @param updated_min: RFC 3339 time, only entries updated since are requested
+        """
+        self.client = KeepAliveClient(base_url or self.BASE_URL % name, cache=cache)
+        self.updated_min = updated_min
+        self.workers = max(1, workers)
+        self.page_size = page_size
+        self.stats = stats
+
+    def header(self):
+        """
+        The feed without entries: its update time and number of entries
+
+        @rtype: lxml.etree._ElementTree
+        """
+        return etree.parse(StringIO(self._get(self._query({'max-results': 0}))))
+
+    def total(self, header=None):
+        """
+        @param header: the feed header if it has been retrieved already
+        @rtype: int
+        """
+        if header is None:
+            header = self.header()
+        return int(TOTAL_RESULTS(header)[0])
+
+    def _query(self, query):
+        if self.updated_min is not None:
+            query['updated-min'] = self.updated_min
+        return query
+
+    def page_query(self, index):
+        return self._query({
+            'start-index': index * self.page_size + 1,
+            'max-results': self.page_size,
+        })
+
+    def fetch_page(self, index):
+        """
+        @return: page body, compressed as sent by the server, and its content encoding
+        """
+        _logger.debug('Retrieving page %d' % index)
+        return self._fetch(self.page_query(index))
+
+    def _get(self, query):
+        body, encoding = self._fetch(query)
+        return decoded(StringIO(body), encoding).read()
+
+    def _fetch(self, query):
+        started = time.time()
+        body, encoding = self.client.fetch(self.FEED_PATH, query)
+        if self.stats is not None:
+            self.stats.add_time('fetch', time.time() - started)
+            self.stats.count('fetched_bytes', len(body))
+            self.stats.count('requests')
+        return body, encoding
+
+    def stream(self, total):
+        """
+        The whole feed in one response, decompressed while the parser reads it.
+        Bypasses the cache, which needs complete bodies.
+
+        @type total: int
+        """
+        _logger.debug('Streaming %d entries' % total)
+        if self.stats is not None:
+            self.stats.count('requests')
+        return self.client.open(self.FEED_PATH, self._query({'start-index': 1, 'max-results': max(1, total)}))
+
+    def pages(self, total=None):
+        """
+        Yields page streams in feed order while later pages are still
+        being downloaded. No more than twice the number of workers pages
+        are held in memory at once, compressed ones are decompressed only
+        while the parser reads them. A feed fitting into a single page is
+        streamed straight from the connection unless it may be cached.
+
+        @type total: int
+        """
+        if total is None:
+            total = self.total()
+
+        count = max(1, (total + self.page_size - 1) // self.page_size)
+        if count == 1 and self.client.cache is None:
+            page = self.stream(total)
+            try:
+                yield page
+            finally:
+                page.close()
+            return
+
+        lock = threading.Condition()
+        window = threading.BoundedSemaphore(self.workers * 2)
+        state = {'next': 0, 'stop': False}
+        results = {}
+
+        def worker():
+            try:
+                while True:
+                    window.acquire()
+                    with lock:
+                        index = state['next']
+                        if state['stop'] or index >= count:
+                            window.release()
+                            return
+                        state['next'] += 1
+
+                    try:
+                        result = (True, self.fetch_page(index))
+                    except Exception, e:
+                        result = (False, e)
+
+                    with lock:
+                        results[index] = result
+                        lock.notify_all()
+            finally:
+                self.client.close()
+
+        threads = [threading.Thread(target=worker, name='fetch-%d' % i) for i in range(min(self.workers, count))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        try:
+            for index in range(count):
+                with lock:
+                    while index not in results:
+                        lock.wait(1)
+                    ok, value = results.pop(index)
+
+                window.release()
+                if not ok:
+                    raise value
+
+                body, encoding = value
+                yield decoded(StringIO(body), encoding)
+        finally:
+            with lock:
+                state['stop'] = True
+            # wake up workers blocked on a full window
+            for _t in threads:
+                try:
+                    window.release()
+                except ValueError:
+                    break
+
+if __name__ == '__main__':
+    import BaseHTTPServer
+    import gzip
+    from hashlib import md5
+    import shutil
+    import SocketServer
+    import tempfile
+    from urlparse import parse_qsl
+    from httpcache import HttpCache
+
+    ENTRIES = 23
+    FEED = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<feed xmlns="%s" xmlns:openSearch="%s"><updated>2012-01-01T00:00:00.000+00:00</updated>'
+            '<openSearch:totalResults>%d</openSearch:totalResults>%%s</feed>' % (NSFEED['a'], NSFEED['s'], ENTRIES))
+    ENTRY = '<entry><id>post-%d</id><content type="html">&lt;p&gt;post %d&lt;/p&gt;</content></entry>'
+
+    # statuses sent, in order
+    sent = []
+
+    class StandIn(BaseHTTPServer.BaseHTTPRequestHandler):
+        """
+        Blogger feed paging with gzip and ETag revalidation
+        """
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            query = dict(parse_qsl(urlsplit(self.path).query))
+            start = int(query.get('start-index', 1))
+            end = min(ENTRIES + 1, start + int(query.get('max-results', 25)))
+            body = FEED % ''.join(ENTRY % (i, i) for i in range(start, end))
+            etag = '"%s"' % md5(body).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                sent.append(304)
+                self.send_response(304)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            out = StringIO()
+            with gzip.GzipFile(fileobj=out, mode='wb') as f:
+                f.write(body)
+            sent.append(200)
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(out.getvalue())))
+            self.end_headers()
+            self.wfile.write(out.getvalue())
+
+        def log_message(self, format, *args):
+            pass
+
+    class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    def entries(fetcher):
+        result = []
+        for page in fetcher.pages():
+            for _event, entry in etree.iterparse(page, tag='{%s}entry' % NSFEED['a']):
+                result.append(etree.tostring(entry))
+        return result
+
+    server = StandInServer(('127.0.0.1', 0), StandIn)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base_url = 'http://127.0.0.1:%d' % server.server_address[1]
+    directory = tempfile.mkdtemp()
+    try:
+        single = entries(BlogspotFetcher('blog', base_url=base_url))
+        assert len(single) == ENTRIES, len(single)
+        paged = entries(BlogspotFetcher('blog', workers=3, page_size=5, base_url=base_url))
+        assert paged == single
+        print 'PAGED: %d entries in %d requests' % (len(paged), len(sent))
+
+        cache = HttpCache(directory)
+        del sent[:]
+        cached = entries(BlogspotFetcher('blog', workers=3, page_size=5, base_url=base_url, cache=cache))
+        assert cached == single and 304 not in sent, sent
+        del sent[:]
+        revalidated = entries(BlogspotFetcher('blog', workers=3, page_size=5, base_url=base_url, cache=cache))
+        # the header is requested again, every page comes from the cache
+        assert revalidated == single and sent == [304] * len(sent), sent
+        print 'REVALIDATED: %d pages' % len(sent)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(directory)
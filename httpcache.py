@@ -0,0 +1,148 @@
+from hashlib import sha1
+import json
+import os
+import tempfile
+import threading
+import logging
+
+_logger = logging.getLogger('feed-fb2.httpcache')
+_logger.addHandler(logging.NullHandler())
+
+def evict(directory, max_size, ext, companions=()):
+    """
+    Removes the least recently used files until the rest fits into the
+    size limit. Use is tracked by file modification time.
+
+    @param ext: extension of the files counted and evicted
+    @param companions: extensions of the files going along with them
+    """
+    files = []
+    total = 0
+    for name in os.listdir(directory):
+        if not name.endswith(ext):
+            continue
+
+        path = os.path.join(directory, name)
+        st = os.stat(path)
+        files.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+
+    for _mtime, size, path in sorted(files):
+        if total <= max_size:
+            break
+
+        _logger.debug('Evicting %s' % path)
+        os.remove(path)
+        for companion in companions:
+            other = path[:-len(ext)] + companion
+            if os.path.exists(other):
+                os.remove(other)
+        total -= size
+
+class HttpCache(object):
+    """
+    Persistent response cache keyed by url.
+
+    Each response is stored as a body file and a json file with its
+    validators. File modification time tracks the last use, the least
+    recently used responses are evicted once the cache outgrows its size
+    limit.
+    """
+    # 1 GiB
+    MAX_SIZE = 1 << 30
+
+    def __init__(self, directory, max_size=MAX_SIZE):
+        """
+        @type directory: str
+        @param max_size: limit for the total size of stored bodies, in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, url, ext):
+        return os.path.join(self.directory, sha1(url).hexdigest() + ext)
+
+    def validators(self, url):
+        """
+        Conditional request headers for a cached response
+
+        @type url: str
+        @rtype: dict
+        """
+        try:
+            with open(self._path(url, '.json')) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+        if meta.get('url') != url or not os.path.exists(self._path(url, '.body')):
+            return {}
+
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        return headers
+
+    def load(self, url):
+        """
+        Body of a cached response, after the server replied 304
+
+        @type url: str
+        @return: body as it was stored and its content encoding
+        """
+        path = self._path(url, '.body')
+        with open(path, 'rb') as f:
+            body = f.read()
+        try:
+            with open(self._path(url, '.json')) as f:
+                encoding = json.load(f).get('encoding')
+        except (IOError, ValueError):
+            encoding = None
+
+        # mark as recently used
+        os.utime(path, None)
+        _logger.debug('Cache hit: %s' % url)
+        return body, encoding
+
+    def store(self, url, headers, body):
+        """
+        @type url: str
+        @param headers: response headers as returned by HTTPResponse.getheaders
+        @param body: response body, compressed bodies are stored as they are
+        @type body: str
+        """
+        headers = dict(headers)
+        meta = {
+            'url': url,
+            'etag': headers.get('etag'),
+            'last_modified': headers.get('last-modified'),
+            'encoding': headers.get('content-encoding'),
+        }
+
+        # responses the server can not revalidate are not worth storing
+        if not meta['etag'] and not meta['last_modified']:
+            return
+
+        if len(body) > self.max_size:
+            return
+
+        with self.lock:
+            self._write(self._path(url, '.body'), body)
+            self._write(self._path(url, '.json'), json.dumps(meta))
+            self._evict()
+
+    def _write(self, path, data):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+    def _evict(self):
+        evict(self.directory, self.max_size, '.body', ['.json'])
@@ -0,0 +1,201 @@
+import base64
+from hashlib import sha1
+import json
+import mimetypes
+from multiprocessing.pool import ThreadPool
+import os
+import tempfile
+import threading
+from urllib2 import urlopen
+import logging
+
+_logger = logging.getLogger('feed-fb2.images')
+_logger.addHandler(logging.NullHandler())
+
+XLINK = 'http://www.w3.org/1999/xlink'
+
+class ImageStore(object):
+    """
+    Downloads images referenced by converted sections and keeps them on
+    disk between runs.
+
+    Image content is stored once per content hash, a small json record maps
+    every url to its content. The binary id is derived from the content hash,
+    so the same picture under different urls is embedded only once.
+    """
+    WORKERS = 8
+    # a multiple of 3, so that every chunk encodes without padding
+    CHUNK = 3 * 1024 * 16
+
+    def __init__(self, directory, workers=WORKERS, timeout=30):
+        """
+        @param directory: on-disk image cache
+        @type directory: str
+        @type workers: int
+        """
+        self.directory = directory
+        self.timeout = timeout
+        self.pool = ThreadPool(workers)
+        self.lock = threading.Lock()
+        # url -> [download result, placeholders registered and not resolved yet]
+        self.pending = {}
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def register(self, section):
+        """
+        Starts downloading every image placeholder of a converted section
+
+        @type section: lxml.etree._Element
+        """
+        for image in section.iter('image'):
+            url = image.get('src')
+            if url is None:
+                continue
+
+            with self.lock:
+                entry = self.pending.get(url)
+                if entry is None:
+                    entry = self.pending[url] = [self.pool.apply_async(self._load, (url,)), 0]
+                entry[1] += 1
+
+    def _load(self, url):
+        """
+        @return: content hash and content type, None if the image is unavailable
+        """
+        index = self._path(sha1(url).hexdigest() + '.json')
+        try:
+            with open(index) as f:
+                record = json.load(f)
+            if os.path.exists(self._path(record['sha1'])):
+                return record['sha1'], record['content_type']
+        except (IOError, ValueError, KeyError):
+            pass
+
+        _logger.debug('Downloading %s' % url)
+        response = None
+        tmp = None
+        try:
+            response = urlopen(url, timeout=self.timeout)
+            content_type = response.info().gettype()
+            # a server not knowing the type of a file says so
+            if content_type == 'application/octet-stream':
+                content_type = mimetypes.guess_type(url)[0] or content_type
+            if not content_type.startswith('image/'):
+                raise ValueError('%s is not an image' % content_type)
+
+            # the image goes to disk chunk by chunk, hashing along the way
+            digest = sha1()
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: response.read(self.CHUNK), ''):
+                    digest.update(chunk)
+                    f.write(chunk)
+
+            content = digest.hexdigest()
+            os.rename(tmp, self._path(content))
+            tmp = None
+        except Exception, e:
+            _logger.warning('Unable to load image %s: %s' % (url, e))
+            return None
+        finally:
+            if response is not None:
+                response.close()
+            # a partial download is not kept
+            if tmp is not None:
+                os.remove(tmp)
+
+        with open(index, 'w') as f:
+            json.dump({'url': url, 'sha1': content, 'content_type': content_type}, f)
+
+        return content, content_type
+
+    def resolve(self, section):
+        """
+        Replaces image placeholders with links to binaries, waiting for the
+        downloads if needed. Images that could not be loaded are dropped.
+
+        @type section: lxml.etree._Element
+        @return: binary id -> (path, content type) of the images the section refers to
+        @rtype: dict
+        """
+        used = {}
+        for image in list(section.iter('image')):
+            url = image.get('src')
+            if url is None:
+                continue
+
+            result = self._release(url).get()
+            parent = image.getparent()
+            if result is None:
+                self._drop(image)
+                continue
+
+            content, content_type = result
+            binary_id = 'img' + content
+            used[binary_id] = (self._path(content), content_type)
+
+            link = image.makeelement('image', {'{%s}href' % XLINK: '#' + binary_id}, nsmap={'xlink': XLINK})
+            link.tail = image.tail
+            parent.replace(image, link)
+
+        return used
+
+    def release(self, section):
+        """
+        Forgets the images of a registered section that is not going to be resolved
+
+        @type section: lxml.etree._Element
+        """
+        for image in section.iter('image'):
+            url = image.get('src')
+            if url is not None:
+                self._release(url)
+
+    def _release(self, url):
+        """
+        @return: download result of a registered placeholder, the url is
+            forgotten once every placeholder registered for it is released
+        """
+        with self.lock:
+            entry = self.pending[url]
+            entry[1] -= 1
+            if not entry[1]:
+                del self.pending[url]
+        return entry[0]
+
+    @classmethod
+    def _drop(cls, image):
+        # text after the image stays in place
+        parent = image.getparent()
+        if image.tail:
+            previous = image.getprevious()
+            if previous is not None:
+                previous.tail = (previous.tail or '') + image.tail
+            else:
+                parent.text = (parent.text or '') + image.tail
+        parent.remove(image)
+
+    def write_binaries(self, xf, binaries, indent=''):
+        """
+        Writes fb2 binary elements, encoding images while they are read from disk
+
+        @param xf: lxml.etree.xmlfile writer
+        @param binaries: collected results of resolve
+        @type binaries: dict
+        """
+        for binary_id in sorted(binaries):
+            path, content_type = binaries[binary_id]
+            xf.write(indent)
+            with xf.element('binary', {'id': binary_id, 'content-type': content_type}):
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(self.CHUNK), ''):
+                        xf.write(base64.b64encode(chunk))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,89 @@
+"""
+Removes subtrees of a post that never make it into the book: scripts,
+embedded players, share buttons and the like. They would still go through
+the converter, which walks every node, only to produce nothing.
+"""
+from collections import OrderedDict
+from lxml import etree
+import logging
+
+_logger = logging.getLogger('feed-fb2.prune')
+_logger.addHandler(logging.NullHandler())
+
+# rule name -> expression selecting the subtrees to remove
+RULES = OrderedDict([
+    ('script', '//script'),
+    ('iframe', '//iframe'),
+    ('object', '//object|//embed'),
+    ('style', '//style'),
+    ('share', "//div[contains(@class, 'share-button') or contains(@class, 'post-share-buttons')"
+              " or contains(@class, 'addthis_toolbox') or contains(@class, 'sharethis')]"),
+    # the jump break Blogger puts after the summary
+    ('more', "//a[@name='more']"),
+])
+DEFAULT_RULES = tuple(RULES)
+
+class Pruner(object):
+    def __init__(self, rules=DEFAULT_RULES):
+        """
+        @param rules: names from RULES
+        """
+        unknown = [name for name in rules if name not in RULES]
+        if unknown:
+            raise ValueError('Unknown pruning rules: %s' % ', '.join(unknown))
+
+        self.rules = tuple(rules)
+        # one union: the tree is searched once whatever the number of rules
+        self.select = etree.XPath('|'.join(RULES[name] for name in self.rules)) if self.rules else None
+
+    def prune(self, tree):
+        """
+        Removes the matching subtrees, the text following them stays in place
+
+        @type tree: lxml.etree._Element
+        @return: number of removed nodes, descendants included
+        @rtype: int
+        """
+        if self.select is None or tree is None:
+            return 0
+
+        root = tree.getroottree().getroot()
+        removed = 0
+        # document order: a subtree is removed before anything inside it is visited
+        for element in self.select(tree):
+            if self._detached(element, root):
+                continue
+
+            removed += sum(1 for _node in element.iter())
+            parent = element.getparent()
+            if element.tail:
+                previous = element.getprevious()
+                if previous is not None:
+                    previous.tail = (previous.tail or '') + element.tail
+                else:
+                    parent.text = (parent.text or '') + element.tail
+            parent.remove(element)
+
+        return removed
+
+    @staticmethod
+    def _detached(element, root):
+        # a removed subtree is cut off, its top is not the document root
+        top = element
+        for top in element.iterancestors():
+            pass
+        return top is not root
+
+_PRUNERS = {}
+
+def pruner(rules):
+    """
+    Pruner compiled once per process for the given rules
+
+    @rtype: Pruner
+    """
+    rules = tuple(rules)
+    found = _PRUNERS.get(rules)
+    if found is None:
+        found = _PRUNERS[rules] = Pruner(rules)
+    return found
@@ -0,0 +1,84 @@
+import sqlite3
+import threading
+import logging
+
+_logger = logging.getLogger('feed-fb2.sectioncache')
+_logger.addHandler(logging.NullHandler())
+
+class SectionCache(object):
+    """
+    Persistent map from (entry id, updated) to the serialized fb2 section.
+
+    The cache is bound to a converter version, a database written by
+    another version is emptied on open. It may be shared between threads.
+    """
+    # puts between commits
+    BATCH = 100
+
+    def __init__(self, path, version):
+        """
+        @type path: str
+        @param version: converter version the stored sections belong to
+        @type version: str
+        """
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.text_factory = str
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS sections ('
+                        'id TEXT, updated TEXT, section BLOB, PRIMARY KEY (id, updated))')
+
+        row = self.db.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+        if row is None or row[0] != version:
+            if row is not None:
+                _logger.info('Converter version changed, clearing %s' % path)
+            self.clear()
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+        self.db.commit()
+
+    def clear(self):
+        self.db.execute('DELETE FROM sections')
+        self.db.commit()
+
+    def get(self, key):
+        """
+        @param key: entry id and updated timestamp
+        @type key: tuple
+        @rtype: str
+        """
+        with self.lock:
+            row = self.db.execute('SELECT section FROM sections WHERE id = ? AND updated = ?', key).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return str(row[0])
+
+    def put(self, key, section):
+        """
+        @type key: tuple
+        @param section: serialized section
+        @type section: str
+        """
+        entry_id, updated = key
+        with self.lock:
+            # older revisions of the entry are of no use anymore
+            self.db.execute('DELETE FROM sections WHERE id = ?', (entry_id,))
+            self.db.execute('INSERT INTO sections VALUES (?, ?, ?)', (entry_id, updated, buffer(section)))
+
+            self.pending += 1
+            if self.pending >= self.BATCH:
+                self.db.commit()
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+        _logger.debug('Section cache: %d hits, %d misses' % (self.hits, self.misses))
@@ -0,0 +1,471 @@
+"""
+Serves blogs converted on demand over http.
+
+    GET /someblog.fb2
+    GET /someblog.fb2.zip?lang=ru&genre=sf_fantasy&genre=ref_ref
+
+Requests are served by threads. With -j above 1 entries are converted by
+a process pool shared by all requests, as in batch.py, so a long conversion
+does not hold up the other requests. With -j 1 every request converts in its
+own thread and the conversions share the interpreter. The book is sent with
+chunked transfer encoding while it is being written.
+
+Built books are kept in an LRU cache keyed by the blog, the feed update
+time, the conversion options and the converter version. Only the feed header is requested before
+the cache is looked up, a book whose feed has not changed is served
+without downloading or converting any entry. Concurrent requests for the
+same book wait for the one building it.
+"""
+import BaseHTTPServer
+from collections import OrderedDict
+from contextlib import contextmanager
+from cStringIO import StringIO
+from hashlib import sha1
+import json
+import multiprocessing
+import os
+import re
+import SocketServer
+import tempfile
+import threading
+from urlparse import parse_qs, urlsplit
+from batch import DEFAULT_GENRE, DEFAULT_LANG
+from blogspot2fb2 import BloggerToBook, converter_version
+from compress import ZIP, compressed
+from fetcher import BlogspotFetcher, FetchError, UPDATED
+from httpcache import evict
+from prune import DEFAULT_RULES
+import logging
+
+_logger = logging.getLogger('feed-fb2.service')
+_logger.addHandler(logging.NullHandler())
+
+class BookCache(object):
+    """
+    Recently built books, the least recently used are evicted first.
+
+    Books are held in memory. With a directory they are also written to
+    disk, which holds more of them and keeps them across restarts.
+    """
+    # 64 MiB
+    MEMORY_SIZE = 64 << 20
+    # 1 GiB
+    DISK_SIZE = 1 << 30
+
+    def __init__(self, memory_size=MEMORY_SIZE, directory=None, disk_size=DISK_SIZE):
+        """
+        @param memory_size: limit for the books held in memory, in bytes
+        @param directory: where books are kept on disk, None for memory only
+        @param disk_size: limit for the books kept on disk, in bytes
+        """
+        self.memory_size = memory_size
+        self.directory = directory
+        self.disk_size = disk_size
+        self.books = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def max_size(self):
+        """
+        Largest book worth storing
+        """
+        return max(self.memory_size, self.disk_size if self.directory is not None else 0)
+
+    def _path(self, key):
+        return os.path.join(self.directory, sha1(key).hexdigest() + '.book')
+
+    def get(self, key):
+        """
+        @type key: str
+        @return: the book or None
+        @rtype: str
+        """
+        with self.lock:
+            book = self.books.pop(key, None)
+            if book is not None:
+                self.books[key] = book
+                return book
+
+        if self.directory is None:
+            return None
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                book = f.read()
+        except IOError:
+            return None
+
+        # mark as recently used
+        os.utime(path, None)
+        with self.lock:
+            self._remember(key, book)
+        return book
+
+    def put(self, key, book):
+        """
+        @type key: str
+        @type book: str
+        """
+        with self.lock:
+            self._remember(key, book)
+            if self.directory is not None and len(book) <= self.disk_size:
+                fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(book)
+                self._keep(key, tmp)
+
+    def put_file(self, key, path):
+        """
+        Takes over a book written into a temporary file of the cache directory
+
+        @type key: str
+        @type path: str
+        """
+        size = os.path.getsize(path)
+        book = None
+        if size <= self.memory_size:
+            with open(path, 'rb') as f:
+                book = f.read()
+
+        with self.lock:
+            if book is not None:
+                self._remember(key, book)
+            if size <= self.disk_size:
+                self._keep(key, path)
+            else:
+                os.remove(path)
+
+    def _keep(self, key, path):
+        os.rename(path, self._path(key))
+        self._evict()
+
+    def _remember(self, key, book):
+        if len(book) > self.memory_size:
+            return
+
+        old = self.books.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.books[key] = book
+        self.size += len(book)
+
+        while self.size > self.memory_size:
+            _key, evicted = self.books.popitem(last=False)
+            self.size -= len(evicted)
+
+    def _evict(self):
+        evict(self.directory, self.disk_size, '.book')
+
+class ChunkedStream(object):
+    """
+    Writes a response body with chunked transfer encoding, small writes
+    are gathered into larger chunks
+    """
+    CHUNK = 1 << 16
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = []
+        self.size = 0
+
+    def write(self, data):
+        if not data:
+            return
+
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.CHUNK:
+            self.flush()
+
+    def flush(self):
+        if self.size:
+            self.stream.write('%x\r\n%s\r\n' % (self.size, ''.join(self.buffer)))
+            self.buffer = []
+            self.size = 0
+        self.stream.flush()
+
+    def close(self):
+        self.flush()
+        self.stream.write('0\r\n\r\n')
+        self.stream.flush()
+
+class Recorder(object):
+    """
+    Passes writes through and keeps a copy of them for the book cache,
+    unless they grow over the largest book it stores. The copy is written
+    into a temporary file of the cache directory, into memory without one.
+    """
+    def __init__(self, stream, book_cache):
+        """
+        @type book_cache: BookCache
+        """
+        self.stream = stream
+        self.book_cache = book_cache
+        self.limit = book_cache.max_size()
+        self.size = 0
+        self.path = None
+        if book_cache.directory is not None:
+            fd, self.path = tempfile.mkstemp(dir=book_cache.directory, suffix='.tmp')
+            self.copy = os.fdopen(fd, 'wb')
+        else:
+            self.copy = StringIO()
+
+    def write(self, data):
+        self.stream.write(data)
+        if self.copy is None:
+            return
+
+        self.size += len(data)
+        if self.size > self.limit:
+            self.discard()
+        else:
+            self.copy.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def save(self, key):
+        """
+        Puts the copy into the book cache, unless it was too large
+        """
+        if self.copy is None:
+            return
+
+        if self.path is None:
+            self.book_cache.put(key, self.copy.getvalue())
+        else:
+            self.copy.close()
+            self.book_cache.put_file(key, self.path)
+        self.copy = None
+
+    def discard(self):
+        if self.copy is None:
+            return
+
+        self.copy.close()
+        if self.path is not None:
+            os.remove(self.path)
+        self.copy = None
+
+class Service(object):
+    """
+    Builds and caches books for the request handlers
+    """
+    def __init__(self, book_cache, pool=None, jobs=1, fetch_workers=BlogspotFetcher.WORKERS,
+                 http_cache=None, base_url=None, **options):
+        """
+        @type book_cache: BookCache
+        @param pool: processes converting entries, shared by all requests
+        @param jobs: size of the pool
+        @type http_cache: httpcache.HttpCache
+        @param base_url: feed host for every blog, e.g. a local stand-in server
+        @param options: passed on to BloggerToBook
+        """
+        self.book_cache = book_cache
+        self.fetch_workers = fetch_workers
+        self.http_cache = http_cache
+        self.base_url = base_url
+        self.options = dict(options, pool=pool, jobs=jobs)
+        # cached books outlive the process with a cache directory
+        prune = options.get('prune')
+        self.version = converter_version(False, options.get('engine'), DEFAULT_RULES if prune is None else prune)
+        # book key -> [lock, number of requests using it]
+        self.building = {}
+        self.lock = threading.Lock()
+
+    def key(self, name, updated, genre, lang, compression):
+        return json.dumps([self.version, name, updated, genre, lang, compression])
+
+    @contextmanager
+    def _building(self, key):
+        with self.lock:
+            entry = self.building.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.building[key]
+
+    def serve(self, handler, name, compression=None, genre=None, lang=None):
+        """
+        @type handler: Handler
+        @param name: blog name
+        @param compression: compress.ZIP or None
+        @type genre: list
+        @type lang: str
+        """
+        genre = genre or [DEFAULT_GENRE]
+        lang = lang or DEFAULT_LANG
+        fetcher = BlogspotFetcher(name, workers=self.fetch_workers, base_url=self.base_url, cache=self.http_cache)
+        try:
+            self._serve(handler, fetcher, name, compression, genre, lang)
+        except FetchError, e:
+            _logger.warning('%s: %s' % (name, e))
+            handler.fail(502, 'Unable to retrieve the feed')
+        except Exception:
+            _logger.exception('Serving %s failed' % name)
+            handler.fail(500, 'Unable to convert the feed')
+        finally:
+            fetcher.client.close()
+
+    def _serve(self, handler, fetcher, name, compression, genre, lang):
+        header = fetcher.header()
+        key = self.key(name, UPDATED(header)[0], genre, lang, compression)
+        book = self.book_cache.get(key)
+        if book is None:
+            with self._building(key):
+                # built by a concurrent request meanwhile
+                book = self.book_cache.get(key)
+                if book is None:
+                    self._build(handler, fetcher, header, name, compression, genre, lang)
+                    return
+
+        _logger.info('Serving %s from the cache' % name)
+        handler.send_book(name, compression, book)
+
+    def _build(self, handler, fetcher, header, name, compression, genre, lang):
+        _logger.info('Converting %s' % name)
+        # the feed header and the first page are retrieved before the status is sent
+        book = BloggerToBook(fetcher.pages(fetcher.total(header)), genre, lang, **self.options)
+
+        handler.send_book(name, compression)
+        chunked = ChunkedStream(handler.wfile)
+        recorder = Recorder(chunked, self.book_cache)
+        try:
+            out = compressed(recorder, compression, '%s.fb2' % name)
+            book.write(out)
+            if out is not recorder:
+                out.close()
+            chunked.close()
+        except Exception:
+            # the status is sent already, the client sees a truncated body
+            _logger.exception('Conversion of %s failed' % name)
+            handler.close_connection = 1
+            recorder.discard()
+            return
+
+        # the feed may have been updated since its header was read
+        recorder.save(self.key(name, book.updated, genre, lang, compression))
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    PATH = re.compile(r'^/([A-Za-z0-9-]+)\.fb2(\.zip)?$')
+    CONTENT_TYPES = {
+        None: 'application/x-fictionbook+xml',
+        ZIP: 'application/zip',
+    }
+
+    def do_GET(self):
+        # whether the status line of this request is sent already
+        self.sending = False
+        parts = urlsplit(self.path)
+        m = self.PATH.match(parts.path)
+        if m is None:
+            self.send_error(404)
+            return
+
+        query = parse_qs(parts.query)
+        self.server.service.serve(self, m.group(1), ZIP if m.group(2) else None,
+                                  query.get('genre'), query.get('lang', [None])[0])
+
+    def send_book(self, name, compression, book=None):
+        """
+        Sends the headers and the book, if it is ready. Otherwise the book
+        follows with chunked transfer encoding.
+        """
+        self.sending = True
+        self.send_response(200)
+        self.send_header('Content-Type', self.CONTENT_TYPES[compression])
+        self.send_header('Content-Disposition', 'attachment; filename="%s.fb2%s"' % (
+            name, '.zip' if compression == ZIP else ''))
+        if book is None:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Content-Length', str(len(book)))
+        self.end_headers()
+
+        if book is not None:
+            self.wfile.write(book)
+
+    def fail(self, code, message):
+        """
+        Sends an error, unless the book is being sent already. Then the
+        connection is closed and the client sees a truncated body.
+        """
+        if self.sending:
+            self.close_connection = 1
+        else:
+            self.send_error(code, message)
+
+    def log_message(self, format, *args):
+        _logger.info('%s %s' % (self.address_string(), format % args))
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        """
+        @type service: Service
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.service = service
+
+if __name__ == '__main__':
+    import optparse
+    from blogspot2fb2 import add_conversion_options, add_worker_options, parse_prune, setup_logging
+    from httpcache import HttpCache
+    from sectioncache import SectionCache
+
+    parser = optparse.OptionParser()
+    parser.add_option("--host", action="store", dest='host', default='127.0.0.1', help='address to listen on')
+    parser.add_option("-p", "--port", action="store", type="int", dest='port', default=8080, help='port to listen on')
+    parser.add_option("--base-url", action="store", dest='base_url', default=None,
+                      help='feed host for every blog instead of blogspot.com')
+    parser.add_option("--book-cache-dir", action="store", dest='book_cache_dir', default=None,
+                      help='directory keeping built books, by default they are kept in memory only')
+    parser.add_option("--book-cache-memory", action="store", type="int", dest='book_cache_memory',
+                      default=BookCache.MEMORY_SIZE >> 20, help='size limit for books kept in memory, MiB')
+    parser.add_option("--book-cache-size", action="store", type="int", dest='book_cache_size',
+                      default=BookCache.DISK_SIZE >> 20, help='size limit for books kept on disk, MiB')
+    add_worker_options(parser, per='book', shared_by='requests')
+    add_conversion_options(parser)
+
+    log = setup_logging()
+
+    options, args = parser.parse_args()
+    if args:
+        parser.error('no arguments expected')
+
+    prune = parse_prune(parser, options)
+
+    http_cache = HttpCache(options.cache_dir, options.cache_size << 20) if options.cache_dir else None
+    book_cache = BookCache(options.book_cache_memory << 20, options.book_cache_dir, options.book_cache_size << 20)
+    section_cache = None
+    if options.section_cache_path:
+        section_cache = SectionCache(options.section_cache_path, converter_version(False, options.engine, prune))
+
+    # the process pool is forked before any thread starts
+    pool = multiprocessing.Pool(options.jobs) if options.jobs > 1 else None
+    service = Service(book_cache, pool, options.jobs, options.fetch_workers, http_cache, options.base_url,
+                      section_cache=section_cache, engine=options.engine, prune=prune)
+    server = Server((options.host, options.port), service)
+    log.info('Serving on %s:%d' % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if section_cache is not None:
+            section_cache.close()
@@ -0,0 +1,97 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import heapq
+import json
+import threading
+import time
+
+class Stats(object):
+    """
+    Wall time per stage, counters and the slowest entries of a run
+    """
+    SLOWEST = 10
+
+    def __init__(self, slowest=SLOWEST):
+        self.times = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.slowest = slowest
+        self.entries = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - started)
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            self.times[stage] += seconds
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def entry(self, title, seconds, size):
+        """
+        Remembers the entry if it is one of the slowest to convert
+        """
+        item = (seconds, size, title)
+        with self.lock:
+            if len(self.entries) < self.slowest:
+                heapq.heappush(self.entries, item)
+            elif item > self.entries[0]:
+                heapq.heapreplace(self.entries, item)
+
+    def as_dict(self):
+        return {
+            'times': dict(self.times),
+            'counters': dict(self.counters),
+            'slowest_entries': [
+                {'title': title, 'seconds': seconds, 'bytes': size}
+                for seconds, size, title in sorted(self.entries, reverse=True)
+            ],
+        }
+
+    def dump(self, stream):
+        json.dump(self.as_dict(), stream, indent=2, sort_keys=True)
+        stream.write('\n')
+
+class NullStats(object):
+    """
+    Collects nothing, used when statistics are off
+    """
+    @contextmanager
+    def timer(self, stage):
+        yield
+
+    def add_time(self, stage, seconds):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def entry(self, title, seconds, size):
+        pass
+
+NULL_STATS = NullStats()
+
+class TimedStream(object):
+    """
+    Output stream wrapper accounting the time spent in write
+    """
+    def __init__(self, stream, stats, stage='write'):
+        self.stream = stream
+        self.stats = stats
+        self.stage = stage
+
+    def write(self, data):
+        started = time.time()
+        self.stream.write(data)
+        self.stats.add_time(self.stage, time.time() - started)
+        self.stats.count('output_bytes', len(data))
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
@@ -0,0 +1,376 @@
+"""
+Incremental update of a book converted before.
+
+A full conversion in sync mode leaves an index next to the book: the feed
+update time, byte offsets of the header, of every section and of the places
+where new sections and images go. The next sync asks Blogger only for the
+entries updated since then, converts them and patches the book in place:
+edited sections are replaced, new ones are added after the last section.
+Nothing is written if no entry changed.
+
+The index also remembers the size of the book and a hash of its header. A
+book rewritten since, or left half patched by an interrupted sync, does not
+match them and is converted again in full.
+
+Only uncompressed single books can be synced. Entries removed from the blog
+stay in the book, entries are never moved, so a new post backdated before
+older ones ends up after them.
+"""
+from cStringIO import StringIO
+from hashlib import sha1
+import json
+import os
+import re
+import shutil
+import tempfile
+from lxml import etree
+import logging
+
+_logger = logging.getLogger('feed-fb2.sync')
+_logger.addHandler(logging.NullHandler())
+
+VERSION_RE = re.compile(r'<version>([^<]*)</version>')
+DATE_RE = re.compile(r'<date value="([^"]*)">([^<]*)</date>')
+# rewritten parts of a book are copied in pieces of this size
+CHUNK = 1 << 16
+
+class BookIndex(object):
+    """
+    Byte offsets of the parts of a book, kept as a json file next to it
+    """
+    FORMAT = 2
+
+    def __init__(self):
+        self.updated = None
+        self.images = False
+        self.header_end = None
+        self.body_end = None
+        self.binaries_end = None
+        self.binaries = set()
+        # entry id -> [updated, start, end]
+        self.entries = {}
+        # the book the offsets belong to
+        self.size = None
+        self.header_hash = None
+
+    @classmethod
+    def path_for(cls, book_path):
+        return book_path + '.idx'
+
+    def add(self, key, start, end):
+        """
+        @param key: entry id and update time
+        @param start: offset of the section, including the preceding indent
+        @param end: offset just after the section
+        """
+        entry_id, updated = key
+        self.entries[entry_id] = [updated, start, end]
+
+    def stamp(self, book_path):
+        """
+        Remembers the book as it is on disk now
+        """
+        self.size, self.header_hash = self._fingerprint(book_path)
+
+    def matches(self, book_path):
+        """
+        @return: whether the book is the one the index was written for
+        @rtype: bool
+        """
+        if self.header_end is None or not os.path.exists(book_path):
+            return False
+        return self._fingerprint(book_path) == (self.size, self.header_hash)
+
+    def _fingerprint(self, book_path):
+        with open(book_path, 'rb') as f:
+            header = f.read(self.header_end)
+            f.seek(0, os.SEEK_END)
+            return f.tell(), sha1(header).hexdigest()
+
+    @classmethod
+    def load(cls, path):
+        """
+        @rtype: BookIndex
+        """
+        with open(path) as f:
+            data = json.load(f)
+        if data.get('format') != cls.FORMAT:
+            raise ValueError('Unsupported book index format: %s' % path)
+
+        index = cls()
+        index.updated = data['updated']
+        index.images = data['images']
+        index.header_end = data['header_end']
+        index.body_end = data['body_end']
+        index.binaries_end = data['binaries_end']
+        index.binaries = set(data['binaries'])
+        index.entries = data['entries']
+        index.size = data['size']
+        index.header_hash = data['header_hash']
+        return index
+
+    def save(self, path):
+        data = {
+            'format': self.FORMAT,
+            'updated': self.updated,
+            'images': self.images,
+            'header_end': self.header_end,
+            'body_end': self.body_end,
+            'binaries_end': self.binaries_end,
+            'binaries': sorted(self.binaries),
+            'entries': self.entries,
+            'size': self.size,
+            'header_hash': self.header_hash,
+        }
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, path)
+
+def render(book, writers):
+    """
+    Serializes parts of a book exactly as they are written inside it
+
+    @type book: blogspot2fb2.BloggerToBook
+    @param writers: callables writing into an etree.xmlfile
+    @return: serialized parts, one per writer
+    @rtype: list
+    """
+    out = StringIO()
+    parts = []
+    with etree.xmlfile(out, encoding='utf-8') as xf:
+        # the namespace declarations of the book are in scope
+        with xf.element('FictionBook', nsmap=book.nsmap()):
+            xf.flush()
+            for write in writers:
+                start = out.tell()
+                write(xf)
+                xf.flush()
+                parts.append(out.getvalue()[start:])
+    return parts
+
+def apply_edits(path, edits):
+    """
+    Replaces byte ranges of a file. Replacements of the same length are
+    written in place, the rest of the file is rewritten starting with the
+    first one changing the length.
+
+    @param edits: non-overlapping (start, end, data) sorted by start
+    """
+    with open(path, 'r+b') as f:
+        i = 0
+        while i < len(edits) and edits[i][1] - edits[i][0] == len(edits[i][2]):
+            start, _end, data = edits[i]
+            f.seek(start)
+            f.write(data)
+            i += 1
+
+        if i == len(edits):
+            return
+
+        # the rest of the file is set aside and copied back in chunks
+        first = edits[i][0]
+        with tempfile.TemporaryFile() as tail:
+            f.seek(first)
+            shutil.copyfileobj(f, tail, CHUNK)
+            tail.seek(0)
+            f.seek(first)
+            position = first
+            for start, end, data in edits[i:]:
+                _copy(tail, f, start - position)
+                f.write(data)
+                tail.seek(end - first)
+                position = end
+            shutil.copyfileobj(tail, f, CHUNK)
+            f.truncate()
+
+def _copy(source, destination, size):
+    """
+    Copies size bytes in chunks
+    """
+    while size > 0:
+        data = source.read(min(size, CHUNK))
+        if not data:
+            raise IOError('unexpected end of file')
+        destination.write(data)
+        size -= len(data)
+
+def _shift(offset, edits):
+    """
+    Offset after the edits, offsets inside a replaced range are not defined
+    """
+    return offset + sum(len(data) - (end - start) for start, end, data in edits if end <= offset)
+
+def sync_book(book, path, index):
+    """
+    Patches a book with the entries of a feed holding the changed ones
+
+    @type book: blogspot2fb2.BloggerToBook
+    @param path: the book written by BloggerToBook.write_indexed
+    @type index: BookIndex
+    @return: whether the book changed, the index is updated then
+    """
+    if not index.matches(path):
+        raise ValueError('%s does not match its index' % path)
+    if (book.images is not None) != index.images:
+        raise ValueError('%s was converted %s images' % (path, 'with' if index.images else 'without'))
+
+    replaced = []
+    added = []
+    binaries = {}
+    for key, _published, section in book.sections():
+        entry_id, updated = key
+        known = index.entries.get(entry_id)
+        if known is not None and known[0] == updated:
+            if book.images is not None:
+                book.images.release(section)
+            continue
+
+        if book.images is not None:
+            binaries.update(book.images.resolve(section))
+        (added if known is None else replaced).append((key, section))
+
+    if not replaced and not added:
+        _logger.info('%s is up to date' % path)
+        return False
+
+    _logger.info('%d entries replaced, %d added' % (len(replaced), len(added)))
+
+    sections = replaced + added
+    new_binaries = dict((k, v) for k, v in binaries.items() if k not in index.binaries)
+    writers = [lambda xf, s=section: xf.write('\n    ', s) for _key, section in sections]
+    if new_binaries:
+        writers.append(lambda xf: book.images.write_binaries(xf, new_binaries, '\n  '))
+    parts = render(book, writers)
+
+    edits = []
+    with open(path, 'rb') as f:
+        header = f.read(index.header_end)
+    version = VERSION_RE.search(header, header.rfind('<document-info>'))
+    if version is not None:
+        new_version = book.description.find('document-info/version').text
+        edits.append((version.start(1), version.end(1), new_version.encode('utf-8')))
+    # the book is dated by the last update of the blog
+    date = DATE_RE.search(header, header.find('<title-info>'), header.find('</title-info>'))
+    if date is not None:
+        new_date = book.description.find('title-info/date')
+        edits.append((date.start(1), date.end(1), new_date.get('value').encode('utf-8')))
+        edits.append((date.start(2), date.end(2), new_date.text.encode('utf-8')))
+
+    for (key, _section), data in zip(replaced, parts):
+        _updated, start, end = index.entries[key[0]]
+        edits.append((start, end, data))
+
+    added_parts = parts[len(replaced):len(sections)]
+    if added_parts:
+        edits.append((index.body_end, index.body_end, ''.join(added_parts)))
+    if new_binaries:
+        edits.append((index.binaries_end, index.binaries_end, parts[-1]))
+
+    edits.sort(key=lambda edit: edit[:2])
+    apply_edits(path, edits)
+
+    # new offsets of the replaced and added sections
+    placed = {}
+    for (key, _section), data in zip(replaced, parts):
+        start = _shift(index.entries[key[0]][1], edits)
+        placed[key] = (start, start + len(data))
+    position = _shift(index.body_end, [e for e in edits if e[0] < index.body_end])
+    for (key, _section), data in zip(added, added_parts):
+        placed[key] = (position, position + len(data))
+        position += len(data)
+
+    for entry in index.entries.values():
+        entry[1] = _shift(entry[1], edits)
+        entry[2] = _shift(entry[2], edits)
+    for key, (start, end) in placed.items():
+        index.add(key, start, end)
+
+    index.header_end = _shift(index.header_end, edits)
+    index.body_end = _shift(index.body_end, edits)
+    index.binaries_end = _shift(index.binaries_end, edits)
+    index.binaries.update(new_binaries)
+    index.updated = book.updated
+    index.stamp(path)
+    return True
+
+if __name__ == '__main__':
+    from xml.sax.saxutils import escape
+    from blogspot2fb2 import BloggerToBook
+
+    def feed(updated, entries):
+        """
+        @param entries: (number, updated, content) newest first
+        """
+        out = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<feed xmlns="http://www.w3.org/2005/Atom">'
+               '<id>tag:blogger.com,1999:blog-1</id><updated>%s</updated>'
+               '<title type="text">Sync</title><subtitle type="html">Self-check</subtitle>'
+               '<link rel="alternate" type="text/html" href="http://sync.blogspot.com/"/>'
+               '<author><name>Sync Check</name><uri>http://sync.blogspot.com/</uri>'
+               '<email>noreply@blogger.com</email></author>' % updated]
+        for number, entry_updated, content in entries:
+            out.append('<entry><id>tag:blogger.com,1999:blog-1.post-%d</id>'
+                       '<published>2012-01-%02dT12:00:00.000+00:00</published><updated>%s</updated>'
+                       '<title type="text">Post %d</title><content type="html">%s</content></entry>'
+                       % (number, number, entry_updated, number, escape(content)))
+        out.append('</feed>')
+        return StringIO(''.join(out))
+
+    def convert(source):
+        return BloggerToBook(source, ['ref_ref'], 'en')
+
+    def undated(data):
+        return [line for line in data.splitlines() if '<date ' not in line]
+
+    first = '2012-01-10T00:00:00.000+00:00'
+    second = '2012-02-10T00:00:00.000+00:00'
+    entries = [(3, first, '<p>third</p>'), (2, first, '<p>second</p>'), (1, first, '<p>first</p>')]
+    # the second post grows, a fourth one appears
+    changed = [(4, second, '<p>fourth</p>'), (2, second, '<p>second, <b>edited</b> and longer</p>')]
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'book.fb2')
+        index = BookIndex()
+        with open(path, 'wb') as f:
+            convert(feed(first, entries)).write_indexed(f, index)
+        index.stamp(path)
+        index.save(BookIndex.path_for(path))
+
+        index = BookIndex.load(BookIndex.path_for(path))
+        assert index.matches(path)
+        # the feed holds the changed entries only, as Blogger returns them since the last sync
+        assert sync_book(convert(feed(second, changed)), path, index)
+        assert not sync_book(convert(feed(second, changed)), path, index)
+
+        fresh = StringIO()
+        convert(feed(second, changed[:1] + entries[:1] + changed[1:] + entries[2:])).write(fresh)
+        with open(path, 'rb') as f:
+            synced = f.read()
+        assert undated(synced) == undated(fresh.getvalue()), (synced, fresh.getvalue())
+        assert '<date value="2012-02-10">2012</date>' in synced
+        assert index.matches(path)
+        print 'SYNCED:', len(synced), 'bytes,', len(index.entries), 'entries'
+
+        # a book written over without its index is not patched
+        with open(path, 'wb') as f:
+            convert(feed(first, entries)).write(f)
+        assert not index.matches(path)
+        print 'STALE INDEX: detected'
+
+        # edits across several chunks, in place and changing the length
+        data = ''.join(chr(ord('a') + i % 26) for i in xrange(3 * CHUNK + 100))
+        edits = [(10, 12, 'XY'), (CHUNK - 1, CHUNK + 1, 'S'),
+                 (2 * CHUNK, 2 * CHUNK, 'inserted'), (3 * CHUNK + 90, 3 * CHUNK + 100, '')]
+        expected = data
+        for start, end, replacement in reversed(edits):
+            expected = expected[:start] + replacement + expected[end:]
+        with open(path, 'wb') as f:
+            f.write(data)
+        apply_edits(path, edits)
+        with open(path, 'rb') as f:
+            assert f.read() == expected
+        print 'EDITS: applied'
+    finally:
+        shutil.rmtree(directory)